@@ -0,0 +1,378 @@
+# تست بار آفلاین ربات
+# Application واقعی telegram_bot_FINAL3 در برابر یک سرور جعلی و محلی Bot API اجرا می‌شود، جریان‌های مصنوعی update
+# (مثلا 10000 کاربر که buy_account، my_status_inline و activate_discount را می‌زنند) از طریق getUpdates به ربات داده
+# می‌شود و برای هر handler توان عملیاتی و تأخیر p50/p95/p99 گزارش می‌شود.
+#
+# اجرا:
+#   python load_test.py --users 10000
+#   python load_test.py --users 2000 --json results.json
+#   python load_test.py --baseline results.json --tolerance 0.2   # اگر p95 بیش از 20% بدتر شود، خروجی 1
+import argparse
+import asyncio
+import email.parser
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from urllib.parse import parse_qsl
+
+FAKE_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTestBot", "username": "load_test_bot"}
+ADMIN_ID = 1
+DISCOUNT_CODE = "LOADTEST"
+
+# هر سناریو دنباله‌ای از updateها برای یک کاربر است: ("callback", data) یا ("text", متن)
+SCENARIOS = {
+    "buy_account": [("callback", "buy_account"), ("callback", "buy_type:1_month")],
+    "my_status_inline": [("callback", "my_status_inline")],
+    "my_credit_inline": [("callback", "my_credit_inline")],
+    "activate_discount": [("callback", "activate_discount"), ("text", DISCOUNT_CODE)],
+    "get_services": [("callback", "get_services"), ("callback", "service_type:V2Ray")],
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+# سرور جعلی Bot API
+# فقط متدهایی که ربات صدا می‌زند شبیه‌سازی می‌شوند؛ بقیه متدها {"ok": true, "result": true} برمی‌گردانند.
+class FakeBotAPI:
+    def __init__(self, api_latency=0.0):
+        self.api_latency = api_latency
+        self.port = None
+        self.calls = defaultdict(int)
+        self.served_at = {} # update_id -> زمان تحویل به ربات
+        self._pending = []
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        # آزاد کردن long-pollهای باقی‌مانده
+        self._new_updates.set()
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def push(self, updates):
+        self._pending.extend(updates)
+        self._new_updates.set()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode().split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = path.rsplit("/", 1)[-1]
+                params = self._parse_params(headers.get("content-type", ""), body)
+                result = await self._call(method, params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            return {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True).decode(errors="replace")
+                for part in message.get_payload()
+                if part.get_filename() is None
+            }
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return dict(parse_qsl(body.decode()))
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            **extra,
+        }
+
+    async def _call(self, method, params):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self._get_updates(params)
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            return self._message(params.get("chat_id", ADMIN_ID), text=params.get("text", ""))
+        if method == "copyMessage":
+            return {"message_id": self._message(params.get("chat_id", ADMIN_ID))["message_id"]}
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [
+                self._message(params.get("chat_id", ADMIN_ID), photo=[{"file_id": f"photo{i}", "file_unique_id": f"u{i}", "width": 1, "height": 1}])
+                for i in range(len(media))
+            ]
+        return True
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        timeout = float(params.get("timeout", 0) or 0)
+        self._pending = [u for u in self._pending if u["update_id"] >= offset]
+        if not self._pending and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        batch = self._pending[:limit]
+        now = time.perf_counter()
+        for u in batch:
+            self.served_at.setdefault(u["update_id"], now)
+        return batch
+
+
+# ساخت updateهای مصنوعی
+def build_updates(scenarios, users, first_user_id):
+    updates = []
+    update_id = 0
+    # هر کاربر سناریوها را به ترتیب اجرا می‌کند؛ updateهای کاربران مختلف در هم تنیده می‌شوند
+    streams = []
+    for offset in range(users):
+        uid = first_user_id + offset
+        steps = [step for name in scenarios for step in SCENARIOS[name]]
+        streams.append((uid, steps))
+    for step_index in range(max(len(steps) for _, steps in streams)):
+        for uid, steps in streams:
+            if step_index >= len(steps):
+                continue
+            kind, value = steps[step_index]
+            update_id += 1
+            user = {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+            chat = {"id": uid, "type": "private"}
+            if kind == "callback":
+                updates.append({"update_id": update_id, "callback_query": {
+                    "id": str(update_id), "from": user, "chat_instance": str(uid), "data": value,
+                    "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "menu"},
+                }})
+            else:
+                updates.append({"update_id": update_id, "message": {
+                    "message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": value,
+                }})
+    return updates
+
+
+# اندازه‌گیری: callback هر handler پوشانده می‌شود تا زمان اجرای آن و تأخیر کامل (از تحویل update تا پایان handler) ثبت شود
+class Recorder:
+    def __init__(self, server, bot_module):
+        self.server = server
+        self.bot_module = bot_module
+        self.handler_latency = defaultdict(list)
+        self.end_to_end = defaultdict(list)
+        self.completed = set()
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    def instrument(self, application):
+        from telegram.ext import ConversationHandler
+
+        # handlerهای پیش از dispatch (گروه‌های منفی) پایان پردازش update نیستند
+        pre_dispatch = (self.bot_module.flood_guard, self.bot_module.restore_persisted_state)
+
+        def wrap_all(handlers):
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    wrap_all(handler.entry_points + handler.fallbacks)
+                    for state_handlers in handler.states.values():
+                        wrap_all(state_handlers)
+                elif isinstance(handler, self.bot_module.ConversationRouter):
+                    wrap_all(handler.conversations)
+                elif getattr(handler.callback, "__wrapped__", handler.callback) not in pre_dispatch:
+                    handler.callback = self._wrap(handler.callback)
+
+        for group_handlers in application.handlers.values():
+            wrap_all(group_handlers)
+
+    def _name(self, callback, update):
+        router = getattr(callback, "__self__", None)
+        if isinstance(router, self.bot_module.CallbackRouter) and update.callback_query:
+            action, _ = self.bot_module.parse_callback(update.callback_query.data)
+            return router._routes[action].__name__
+        return callback.__name__
+
+    def _wrap(self, callback):
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                finished = time.perf_counter()
+                name = self._name(callback, update)
+                self.handler_latency[name].append(finished - started)
+                served = self.server.served_at.get(update.update_id)
+                if served is not None:
+                    self.end_to_end[name].append(finished - served)
+                self.completed.add(update.update_id)
+                if len(self.completed) >= self.expected:
+                    self.done.set()
+        timed.__name__ = callback.__name__
+        return timed
+
+    def report(self, wall_time):
+        results = {}
+        for name in sorted(self.handler_latency):
+            handler_times = sorted(self.handler_latency[name])
+            e2e_times = sorted(self.end_to_end[name])
+            results[name] = {
+                "count": len(handler_times),
+                "throughput": len(handler_times) / wall_time,
+                "p50_ms": percentile(handler_times, 50) * 1000,
+                "p95_ms": percentile(handler_times, 95) * 1000,
+                "p99_ms": percentile(handler_times, 99) * 1000,
+                "e2e_p50_ms": percentile(e2e_times, 50) * 1000,
+                "e2e_p95_ms": percentile(e2e_times, 95) * 1000,
+                "e2e_p99_ms": percentile(e2e_times, 99) * 1000,
+            }
+        return results
+
+
+def print_report(results, wall_time, total, api_calls):
+    print(f"\n{total} updates in {wall_time:.2f}s ({total / wall_time:.0f} updates/s)")
+    header = f"{'handler':<28}{'count':>8}{'ops/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'e2e p50':>10}{'e2e p95':>10}{'e2e p99':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(
+            f"{name:<28}{r['count']:>8}{r['throughput']:>9.0f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+            f"{r['e2e_p50_ms']:>10.1f}{r['e2e_p95_ms']:>10.1f}{r['e2e_p99_ms']:>10.1f}"
+        )
+    print("(latencies in ms; e2e = from getUpdates delivery to handler completion)")
+    print("Bot API calls: " + ", ".join(f"{method}={count}" for method, count in sorted(api_calls.items())))
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["handlers"]
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base and base["p95_ms"] > 0 and r["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']:.2f}ms -> {r['p95_ms']:.2f}ms")
+    for line in regressions:
+        print("REGRESSION " + line)
+    return not regressions
+
+
+async def run(args):
+    server = FakeBotAPI(api_latency=args.api_latency_ms / 1000)
+    await server.start()
+
+    workdir = tempfile.mkdtemp(prefix="bot-load-test-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": FAKE_TOKEN,
+        "ADMIN_TELEGRAM_ID": str(ADMIN_ID),
+        "DB_PATH": os.path.join(workdir, "users.db"),
+        "TELEGRAM_API_BASE_URL": server.base_url,
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import telegram_bot_FINAL3 as bot
+
+    scenarios = args.scenarios.split(",")
+    first_user_id = 1_000_000
+    await asyncio.to_thread(bot.open_database)
+    # کاربران از قبل ثبت‌نام و تأیید شده‌اند تا سناریوها به مسیر اصلی برسند
+    await bot.db.executemany(
+        "INSERT INTO users (id, username, is_approved) VALUES (?, ?, 1)",
+        [(first_user_id + i, f"user{first_user_id + i}") for i in range(args.users)]
+    )
+    await bot.db.execute("INSERT OR IGNORE INTO codes (code, value) VALUES (?, ?)", (DISCOUNT_CODE, 1000))
+
+    application = bot.build_application()
+    recorder = Recorder(server, bot)
+    recorder.instrument(application)
+    updates = build_updates(scenarios, args.users, first_user_id)
+    recorder.expected = len(updates)
+
+    await application.initialize()
+    await bot.initialize_conversation_persistence(application)
+    await application.start()
+    await application.updater.start_polling(poll_interval=0.0, timeout=1, allowed_updates=bot.allowed_updates_for(application.handlers))
+
+    started = time.perf_counter()
+    if args.rate:
+        # ارسال با نرخ ثابت (update در ثانیه)
+        for i in range(0, len(updates), 100):
+            server.push(updates[i:i + 100])
+            await asyncio.sleep(100 / args.rate)
+    else:
+        server.push(updates)
+    try:
+        await asyncio.wait_for(recorder.done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"timeout: only {len(recorder.completed)} of {len(updates)} updates were handled")
+    wall_time = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    await server.stop()
+
+    results = recorder.report(wall_time)
+    print_report(results, wall_time, len(recorder.completed), server.calls)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"updates": len(updates), "wall_time": wall_time, "handlers": results}, f, indent=2)
+    if args.baseline:
+        return 0 if compare_with_baseline(results, args.baseline, args.tolerance) else 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test against a fake Telegram Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="number of synthetic users")
+    parser.add_argument("--scenarios", default="buy_account,my_status_inline,activate_discount",
+                        help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--rate", type=float, default=0, help="updates per second (0 = all at once)")
+    parser.add_argument("--api-latency-ms", type=float, default=0, help="simulated Bot API latency")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for all updates")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare p95 with a previous --json result")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 regression (0.2 = 20%%)")
+    args = parser.parse_args()
+    unknown = set(args.scenarios.split(",")) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,1189 @@
 import os
+import asyncio
+import bisect
+import csv
+import hashlib
+import heapq
+import io
+import json
+import multiprocessing
+import queue
+import secrets
+import signal
 import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import closing
+from functools import lru_cache, wraps
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
-    filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+    filters, ContextTypes, ConversationHandler, CallbackQueryHandler, TypeHandler,
+    BasePersistence, PersistenceInput, ApplicationHandlerStop, BaseUpdateProcessor, BaseHandler
 )
+from telegram.error import Forbidden, NetworkError, RetryAfter, TelegramError, TimedOut
+from telegram.request import HTTPXRequest
 
 # بارگذاری توکن از .env
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_TELEGRAM_ID"))
+# آدرس Bot API (برای سرور محلی telegram-bot-api یا سرور جعلی تست بار)، مثال: http://127.0.0.1:8081/bot
+BOT_API_URL = os.getenv("TELEGRAM_API_BASE_URL")
 
-# اتصال به دیتابیس
-conn = sqlite3.connect("users.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# ساخت جداول دیتابیس
-# جدول users
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY,
-    username TEXT,
-    credit INTEGER DEFAULT 0,
-    discount_used INTEGER DEFAULT 0,
-    is_approved INTEGER DEFAULT 0
-)
-""")
-# جدول codes
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS codes (
-    code TEXT PRIMARY KEY,
-    value INTEGER
-)
-""")
-# جدول services (با فیلد جدید is_file برای پشتیبانی از فایل‌ها)
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS services (
-    type TEXT PRIMARY KEY,
-    content TEXT,         -- ذخیره لینک/متن کانفیگ یا Telegram file_id
-    is_file INTEGER DEFAULT 0 -- 0 برای متن/لینک، 1 برای فایل
+# مسیر فایل دیتابیس
+DB_PATH = os.getenv("DB_PATH", "users.db")
+
+
+# تعداد اتصال‌های فقط‌خواندنی (reader) به دیتابیس
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+# پنجره جمع‌آوری نوشتن‌ها برای commit گروهی (میلی‌ثانیه) و حداکثر تعداد نوشتن در یک تراکنش
+DB_WRITE_BATCH_MS = float(os.getenv("DB_WRITE_BATCH_MS", "5"))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", "500"))
+# حداکثر تعداد updateهایی که همزمان پردازش می‌شوند (updateهای یک کاربر همیشه به ترتیب اجرا می‌شوند).
+# pool اتصال‌های HTTP دو برابر این عدد است؛ مقدار خیلی بزرگ (مثلا 256) زمان‌بندی pool در httpcore را کند می‌کند.
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "32"))
+
+
+# **سنجه‌ها (metrics)**
+# هیستوگرام تأخیر handlerها (بر اساس نام handler / action دکمه)، زمان اجرای هر دستور SQL، تأخیر و خطای
+# فراخوانی‌های Bot API و تعداد کاربران در هر وضعیت مکالمه. خروجی با فرمت متنی Prometheus روی یک پورت محلی
+# (METRICS_PORT) و به صورت خلاصه با دستور /stats برای ادمین در دسترس است.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # 0 = غیرفعال
+# مرزهای سطل‌های هیستوگرام (ثانیه)
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # آخرین خانه: بیشتر از بزرگ‌ترین مرز (+Inf)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # تقریب: مرز بالای سطلی که چندک q در آن قرار دارد
+        target = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += n
+            if cumulative >= target:
+                return bound
+        return float("inf")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metrics:
+    # از event loop و threadهای دیتابیس صدا زده می‌شود، پس تغییرات زیر قفل انجام می‌شوند
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._histograms = defaultdict(dict) # name -> {labels: Histogram}
+        self._counters = defaultdict(lambda: defaultdict(int)) # name -> {labels: value}
+        self._gauges = {} # name -> تابعی که [(labels dict, value)] برمی‌گرداند
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms[name].get(key)
+            if histogram is None:
+                histogram = self._histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[name][tuple(sorted(labels.items()))] += amount
+
+    def gauge(self, name, fn):
+        self._gauges[name] = fn
+
+    def histograms(self, name):
+        with self._lock:
+            return {key: (h.count, h.sum, h.quantile(0.5), h.quantile(0.95)) for key, h in self._histograms[name].items()}
+
+    def counters(self, name):
+        with self._lock:
+            return dict(self._counters[name])
+
+    def render(self):
+        lines = [f"bot_uptime_seconds {time.time() - self.started:.0f}"]
+        with self._lock:
+            for name, series in self._histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for key, h in series.items():
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + (float("inf"),), h.counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {h.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {h.count}")
+            for name, series in self._counters.items():
+                lines.append(f"# TYPE {name} counter")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+        for name, fn in self._gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in fn():
+                lines.append(f"{name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql):
+    # برچسب کوتاه و یکتا برای هر دستور SQL (فاصله‌های اضافه حذف می‌شوند)
+    statement = " ".join(sql.split())
+    return statement if len(statement) <= 120 else statement[:117] + "..."
+
+
+
+# لایه دسترسی ناهمگام به دیتابیس (connection manager)
+# - یک اتصال نویسنده (writer) روی یک thread اختصاصی: نوشتن‌های همزمان handlerها در یک صف جمع می‌شوند و
+#   نوشتن‌هایی که تا آزاد شدن writer در صف جمع شده‌اند با هم در یک تراکنش commit می‌شوند (group commit: یک fsync
+#   برای کل دسته)؛ نوشتن تنها بدون هیچ انتظاری commit می‌شود.
+#   هر نوشتن داخل SAVEPOINT خودش اجرا می‌شود، پس خطای یکی بقیه را خراب نمی‌کند، و handler تا commit
+#   واقعی منتظر future خودش می‌ماند.
+# - یک pool از اتصال‌های خواننده (reader) روی threadهای جدا: خواندن‌ها (اعتبار/وضعیت) همزمان اجرا می‌شوند
+# - حالت WAL باعث می‌شود خواننده‌ها هیچ‌وقت پشت نوشتن‌ها منتظر نمانند
+# event loop هیچ‌وقت منتظر دیسک (fsync) نمی‌ماند.
+class Database:
+    def __init__(self, path, readers=DB_READERS, batch_ms=DB_WRITE_BATCH_MS, batch_max=DB_WRITE_BATCH_MAX):
+        self.path = path
+        self.batch_window = batch_ms / 1000
+        self.batch_max = batch_max
+        self.readers = readers
+        self._readers = None
+        self._local = threading.local()
+        self._writes = queue.Queue()
+        self._writer = None
+
+    def open(self):
+        # اتصال‌ها تا شروع Application باز نمی‌شوند (import و راه‌اندازی سریع می‌ماند)
+        if self._writer is not None:
+            return
+        self._readers = ThreadPoolExecutor(max_workers=self.readers, thread_name_prefix="sqlite-reader")
+        self._writer = threading.Thread(target=self._writer_loop, name="sqlite-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self, readonly):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA busy_timeout=30000")
+        if not readonly:
+            conn.isolation_level = None # تراکنش‌های writer دستی (BEGIN/SAVEPOINT/COMMIT) مدیریت می‌شوند
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # در حالت WAL امن است و fsync هر commit را حذف می‌کند
+        conn.execute("PRAGMA cache_size=-16000")   # حدود 16 مگابایت کش صفحات برای هر اتصال
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _reader_connection(self):
+        # هر thread خواننده اتصال مخصوص خودش را دارد (اتصال‌ها بین threadها به اشتراک گذاشته نمی‌شوند)
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(readonly=True)
+        return conn
+
+    def _next_batch(self):
+        # منتظر اولین نوشتن می‌ماند و هر چه در صف جمع شده را بدون انتظار برمی‌دارد؛ نوشتن تنها فورا commit می‌شود.
+        # فقط وقتی چند نوشتن همزمان در صف بوده (بار بالا) تا پایان پنجره برای بقیه صبر می‌کند.
+        batch = [self._writes.get()]
+        self._drain(batch)
+        if len(batch) > 1 and self.batch_window > 0:
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_max and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._writes.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                self._drain(batch)
+        return batch
+
+    def _drain(self, batch):
+        while len(batch) < self.batch_max and batch[-1] is not None:
+            try:
+                batch.append(self._writes.get_nowait())
+            except queue.Empty:
+                return
+
+    def _writer_loop(self):
+        conn = self._connect(readonly=False)
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            work = [item for item in batch if item is not None]
+            results = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for fn, future in work:
+                    conn.execute("SAVEPOINT write")
+                    try:
+                        results.append((future, fn(conn), None))
+                        conn.execute("RELEASE write")
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO write")
+                        conn.execute("RELEASE write")
+                        results.append((future, None, e))
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                results = [(future, None, e) for _, future in work]
+            for future, result, error in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            if stop:
+                conn.close()
+                return
+
+    def _submit(self, fn):
+        # fn(conn) در تراکنش گروهی بعدی اجرا می‌شود؛ خروجی یک concurrent.futures.Future است
+        if self._writer is None:
+            raise RuntimeError("Database is not open")
+        future = Future()
+        self._writes.put((fn, future))
+        return future
+
+    @staticmethod
+    def _timed(label, fn, conn):
+        # زمان اجرای خود دستور (بدون انتظار در صف) در bot_db_query_seconds ثبت می‌شود
+        started = time.perf_counter()
+        try:
+            return fn(conn)
+        except sqlite3.Error as e:
+            metrics.inc("bot_db_errors_total", statement=label, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_db_query_seconds", time.perf_counter() - started, statement=label)
+
+    def _fetchone(self, sql, params):
+        def read(conn):
+            with closing(conn.cursor()) as cur:
+                return cur.execute(sql, params).fetchone()
+        return self._timed(statement_label(sql), read, self._reader_connection())
+
+    def _fetchall(self, sql, params):
+        def read(conn):
+            with closing(conn.cursor()) as cur:
+                return cur.execute(sql, params).fetchall()
+        return self._timed(statement_label(sql), read, self._reader_connection())
+
+    def _read_snapshot(self, fn):
+        def read(conn):
+            conn.execute("BEGIN") # همه کوئری‌های fn یک snapshot ثابت از دیتابیس را می‌بینند
+            try:
+                return fn(conn)
+            finally:
+                conn.rollback()
+        return self._timed(f"read {fn.__name__}", read, self._reader_connection())
+
+    async def _read(self, fn, *args):
+        if self._readers is None:
+            raise RuntimeError("Database is not open")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, fn, *args)
+
+    async def _write(self, label, fn):
+        # زمان کل نوشتن از دید handler (صف + commit گروهی) در bot_db_commit_seconds ثبت می‌شود
+        started = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(self._submit(lambda conn: self._timed(label, fn, conn)))
+        finally:
+            metrics.observe("bot_db_commit_seconds", time.perf_counter() - started)
+
+    async def execute(self, sql, params=()):
+        def write(conn):
+            with closing(conn.cursor()) as cur:
+                return cur.execute(sql, params).rowcount
+        return await self._write(statement_label(sql), write)
+
+    async def executemany(self, sql, seq_of_params):
+        def write(conn):
+            with closing(conn.cursor()) as cur:
+                return cur.executemany(sql, seq_of_params).rowcount
+        return await self._write(statement_label(sql), write)
+
+    @staticmethod
+    def _iter_rows(cur, batch_size):
+        # iterator روی cursor: ردیف‌ها دسته‌دسته (fetchmany) خوانده می‌شوند، پس حافظه مستقل از اندازه جدول است
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def _write_csv(self, fileobj, header, sql, params, batch_size):
+        def export(conn):
+            writer = csv.writer(fileobj)
+            writer.writerow(header)
+            count = 0
+            with closing(conn.cursor()) as cur:
+                cur.execute(sql, params)
+                for row in self._iter_rows(cur, batch_size):
+                    writer.writerow(row)
+                    count += 1
+            return count
+        return self._timed(statement_label(sql), export, self._reader_connection())
+
+    async def export_csv(self, fileobj, header, sql, params=(), batch_size=1000):
+        # خروجی کوئری مستقیم (ردیف به ردیف) در fileobj نوشته می‌شود؛ تعداد ردیف‌ها را برمی‌گرداند
+        return await self._read(self._write_csv, fileobj, header, sql, params, batch_size)
+
+    async def fetchone(self, sql, params=()):
+        return await self._read(self._fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self._read(self._fetchall, sql, params)
+
+    async def read(self, fn):
+        # fn(conn) با چند کوئری مرتبط روی یک اتصال خواننده و داخل یک تراکنش فقط‌خواندنی اجرا می‌شود
+        return await self._read(self._read_snapshot, fn)
+
+    async def transaction(self, fn):
+        # fn(conn) به صورت اتمیک (داخل SAVEPOINT خودش) روی writer اجرا می‌شود؛ در صورت خطا همه تغییراتش برگشت می‌خورند
+        return await self._write(f"transaction {fn.__name__}", fn)
+
+    def queue_depth(self):
+        return self._writes.qsize()
+
+    def run_sync(self, fn):
+        # فقط برای زمان راه‌اندازی (خارج از event loop)
+        return self._submit(fn).result()
+
+    def close(self):
+        # نوشتن‌های در صف commit می‌شوند و بعد thread نویسنده متوقف می‌شود
+        if self._writer is None:
+            return
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+
+
+db = Database(DB_PATH)
+
+
+# **مهاجرت‌های نسخه‌دار schema**
+# نسخه schema در PRAGMA user_version ذخیره می‌شود و فقط مهاجرت‌های اجرا نشده (به ترتیب و در یک تراکنش) اعمال می‌شوند؛
+# اگر دیتابیس به‌روز باشد هیچ دستور DDL اجرا نمی‌شود. هر مهاجرت idempotent است (IF NOT EXISTS / add_column_if_missing)
+# تا دیتابیس‌های قدیمی که جدول‌ها را بدون user_version ساخته‌اند هم درست ارتقا پیدا کنند.
+# تغییر جدید schema = یک تابع جدید در انتهای MIGRATIONS (مهاجرت‌های قبلی هرگز ویرایش نمی‌شوند).
+def migrate_base_tables(conn):
+    # جدول users
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        credit INTEGER DEFAULT 0,
+        discount_used INTEGER DEFAULT 0,
+        is_approved INTEGER DEFAULT 0
+    )
+    """)
+    # جدول codes
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS codes (
+        code TEXT PRIMARY KEY,
+        value INTEGER
+    )
+    """)
+    # جدول services (با فیلد is_file برای پشتیبانی از فایل‌ها)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS services (
+        type TEXT PRIMARY KEY,
+        content TEXT,         -- ذخیره لینک/متن کانفیگ یا Telegram file_id
+        is_file INTEGER DEFAULT 0 -- 0 برای متن/لینک، 1 برای فایل
+    )
+    """)
+    # دیتابیس‌هایی که جدول services را قبل از اضافه شدن is_file ساخته‌اند
+    add_column_if_missing(conn, "services", "is_file", "INTEGER DEFAULT 0")
+
+
+def migrate_broadcast_jobs(conn):
+    # کاربرانی که ربات را بلاک کرده‌اند در ارسال همگانی نادیده گرفته می‌شوند
+    add_column_if_missing(conn, "users", "is_blocked", "INTEGER DEFAULT 0")
+    # جدول broadcast_jobs (پیشرفت ارسال همگانی برای ادامه پس از ری‌استارت)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT DEFAULT 'running', -- running یا done
+        last_user_id INTEGER DEFAULT 0, -- آخرین کاربری که دسته‌اش کامل ارسال شده
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        created_at INTEGER,
+        updated_at INTEGER
+    )
+    """)
+
+
+def migrate_pending_index(conn):
+    # ایندکس جزئی برای صف کاربران در انتظار تأیید (فقط ردیف‌های is_approved=0 را نگه می‌دارد)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_pending ON users (id) WHERE is_approved = 0")
+
+
+def migrate_ledger(conn):
+    # جدول ledger (دفتر کل اعتبار: هر حرکت اعتبار یک ردیف غیرقابل تغییر؛ users.credit موجودی تجمیع‌شده است)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        delta INTEGER NOT NULL,
+        kind TEXT NOT NULL, -- discount / charge / transfer_in / transfer_out
+        ref TEXT,           -- کد تخفیف، طرف مقابل انتقال و ...
+        created_at INTEGER NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_user_time ON ledger (user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_ledger_time ON ledger (created_at)")
+    # جدول balance_snapshots (موجودی کاربران در هر checkpoint؛ موجودی در هر زمان = آخرین snapshot + حرکات بعد از آن)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user_id INTEGER NOT NULL,
+        ledger_id INTEGER NOT NULL, -- آخرین ردیف ledger که در این snapshot لحاظ شده
+        balance INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (user_id, ledger_id)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+        ledger_id INTEGER PRIMARY KEY,
+        created_at INTEGER NOT NULL
+    )
+    """)
+
+
+def migrate_persistence(conn):
+    # جداول ذخیره وضعیت مکالمه‌ها و user_data (برای ادامه مکالمه‌ها پس از ری‌استارت)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS persisted_user_data (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL, -- JSON
+        updated_at INTEGER
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS persisted_conversations (
+        key TEXT NOT NULL,  -- JSON کلید مکالمه: [chat_id, user_id]
+        name TEXT NOT NULL, -- نام ConversationHandler
+        state TEXT NOT NULL,
+        updated_at INTEGER,
+        PRIMARY KEY (key, name)
+    )
+    """)
+
+
+def migrate_media_cache(conn):
+    # جدول media_cache (file_id تصاویر آپلود شده؛ با تغییر فایل نامعتبر می‌شود)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS media_cache (
+        path TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        mtime_ns INTEGER,
+        size INTEGER,
+        sha256 TEXT
+    )
+    """)
+
+
+def migrate_code_limits(conn):
+    # محدودیت تعداد استفاده (NULL = نامحدود) و تاریخ انقضای کدهای تخفیف (unix time، NULL = بدون انقضا)
+    add_column_if_missing(conn, "codes", "max_uses", "INTEGER")
+    add_column_if_missing(conn, "codes", "uses", "INTEGER DEFAULT 0")
+    add_column_if_missing(conn, "codes", "expires_at", "INTEGER")
+
+
+def migrate_stock(conn):
+    # جدول stock (اکانت/کانفیگ‌های از پیش آماده برای تحویل خودکار؛ claimed_by = NULL یعنی موجود)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS stock (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        product TEXT NOT NULL, -- کلید محصول، مثال: 1_month یا V2Ray
+        content TEXT NOT NULL,
+        claimed_by INTEGER,
+        claimed_at INTEGER,
+        created_at INTEGER NOT NULL,
+        UNIQUE (product, content)
+    )
+    """)
+    # ایندکس جزئی فقط روی آیتم‌های موجود: برداشتن اولین آیتم و شمارش موجودی بدون پیمایش آیتم‌های فروخته‌شده
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_stock_available ON stock (product, id) WHERE claimed_by IS NULL")
+
+
+def migrate_relay(conn):
+    # جدول relay: هر پیام کپی‌شده بین ادمین و کاربر -> پیام مبدأ آن، تا reply روی آن به طرف مقابل برسد
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS relay (
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        peer_chat_id INTEGER NOT NULL,
+        peer_message_id INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (chat_id, message_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_relay_created ON relay (created_at)")
+
+
+def migrate_callback_claims(conn):
+    # جدول callback_claims: هر دکمه‌ای که کار ماندگار انجام می‌دهد (خرید، تأیید، ارسال آیتم) فقط یک بار اجرا می‌شود
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS callback_claims (
+        user_id INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (user_id, data, message_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_callback_claims_created ON callback_claims (created_at)")
+
+
+def migrate_requests(conn):
+    # جدول requests: سفارش اکانت/سرویس و درخواست افزایش اعتبار (status: open، done، rejected، cancelled)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL, -- account، service یا topup
+        product TEXT, -- کلید محصول، مثال: 1_month یا V2Ray
+        note TEXT, -- توضیح کاربر (افزایش اعتبار)
+        status TEXT NOT NULL DEFAULT 'open',
+        handled_by INTEGER,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    )
+    """)
+    # صف درخواست‌های باز هر نوع (صفحه‌بندی با id)، تاریخچه هر کاربر، و حداکثر یک سفارش باز برای هر کاربر
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_open ON requests (kind, id) WHERE status = 'open'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_user ON requests (user_id, id)")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_requests_one_open ON requests (user_id) "
+        "WHERE status = 'open' AND kind IN ('account', 'service')"
+    )
+
+
+def migrate_subscriptions(conn):
+    # جدول subscriptions: اشتراک‌های زمان‌دار فروخته‌شده؛ due_at موعد رویداد بعدی (یادآوری یا انقضا) است و
+    # برای اشتراک‌های منقضی‌شده NULL می‌شود تا ایندکس جزئی فقط اشتراک‌های فعال را نگه دارد
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        product TEXT NOT NULL,
+        request_id INTEGER,
+        starts_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'active', -- active یا expired
+        stage TEXT, -- رویداد بعدی: remind یا expire
+        due_at INTEGER
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_due ON subscriptions (due_at, id) WHERE due_at IS NOT NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions (user_id, product) WHERE status = 'active'")
+
+
+# نسخه schema = تعداد مهاجرت‌ها؛ فقط به انتها اضافه کنید
+MIGRATIONS = (
+    migrate_base_tables,
+    migrate_broadcast_jobs,
+    migrate_pending_index,
+    migrate_ledger,
+    migrate_persistence,
+    migrate_media_cache,
+    migrate_code_limits,
+    migrate_stock,
+    migrate_relay,
+    migrate_callback_claims,
+    migrate_requests,
+    migrate_subscriptions,
 )
-""")
-conn.commit()
 
-# **توجه:** اگر قبلا جدول services را ایجاد کرده‌اید و می‌خواهید فیلد is_file را اضافه کنید،
-# باید این خط را یک بار به صورت دستی (نه داخل کد اصلی ربات) اجرا کنید:
-# cursor.execute("ALTER TABLE services ADD COLUMN IF NOT EXISTS is_file INTEGER DEFAULT 0")
-# conn.commit()
+
+def add_column_if_missing(conn, table, column, decl):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def migrate(conn):
+    # روی writer و داخل یک تراکنش اجرا می‌شود: اگر یک مهاجرت خطا بدهد، هیچ‌کدام (و user_version) اعمال نمی‌شوند
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Database schema version {version} is newer than this bot ({len(MIGRATIONS)})")
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration(conn)
+        conn.execute(f"PRAGMA user_version = {number}")
+    return version
+
+
+def open_database():
+    # باز کردن اتصال‌ها و اعمال مهاجرت‌های باقی‌مانده (در post_init، قبل از پردازش اولین update)
+    db.open()
+    version = db.run_sync(migrate)
+    if version < len(MIGRATIONS):
+        print(f"Database migrated from schema version {version} to {len(MIGRATIONS)}")
+
+# کش رکورد کاربران (LRU با TTL) جلوی جدول users
+# مسیرهای پرتکرار (اعتبار/وضعیت/تأیید) از حافظه خوانده می‌شوند و هر نوشتن روی users، کش را همزمان به‌روز می‌کند (write-through).
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+UserRecord = namedtuple("UserRecord", ["credit", "discount_used", "is_approved"])
+
+
+class UserCache:
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # uid -> (expires_at, UserRecord)
+        self._writes = 0 # شمارنده نوشتن‌ها برای جلوگیری از ذخیره مقدار کهنه توسط خواندن همزمان
+
+    async def get(self, uid):
+        entry = self._entries.get(uid)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        writes_before = self._writes
+        row = await db.fetchone("SELECT credit, discount_used, is_approved FROM users WHERE id=?", (uid,))
+        if row is None:
+            return None
+        record = UserRecord(*row)
+        if self._writes == writes_before:
+            self._put(uid, record)
+        return record
+
+    def _put(self, uid, record):
+        self._entries[uid] = (time.monotonic() + self.ttl, record)
+        self._entries.move_to_end(uid)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def update(self, uid, **fields):
+        # بعد از هر UPDATE روی users صدا زده می‌شود
+        self._writes += 1
+        entry = self._entries.get(uid)
+        if entry is not None:
+            self._put(uid, entry[1]._replace(**fields))
+        publish_invalidation("user", uid)
+
+    def adjust_credit(self, uid, delta):
+        self._writes += 1
+        entry = self._entries.get(uid)
+        if entry is not None:
+            self._put(uid, entry[1]._replace(credit=entry[1].credit + delta))
+        publish_invalidation("user", uid)
+
+    def invalidate(self, uid):
+        self.forget(uid)
+        publish_invalidation("user", uid)
+
+    def forget(self, uid):
+        # فقط کش همین پردازش (برای باطل‌سازی‌هایی که از workerهای دیگر می‌رسد)
+        self._writes += 1
+        self._entries.pop(uid, None)
+
+    def clear(self, publish=True):
+        # بعد از تغییرات گروهی (مثلا ورود CSV) به جای باطل کردن تک‌تک کاربران
+        self._writes += 1
+        self._entries.clear()
+        if publish:
+            publish_invalidation("all_users")
+
+
+user_cache = UserCache()
+
+
+# **دفتر کل اعتبار (ledger)**
+# هر حرکت اعتبار در یک تراکنش اتمیک هم users.credit را تغییر می‌دهد و هم یک ردیف در ledger ثبت می‌کند،
+# پس خواندن موجودی O(1) می‌ماند و تاریخچه/حسابرسی با ایندکس (user_id, created_at) سریع است.
+LEDGER_CHECKPOINT_INTERVAL = int(os.getenv("LEDGER_CHECKPOINT_INTERVAL", "3600")) # ثانیه
+LEDGER_HISTORY_LIMIT = 10
+
+LEDGER_KIND_LABELS = {
+    "discount": "🎁 کد تخفیف",
+    "charge": "💰 شارژ توسط ادمین",
+    "transfer_in": "📥 انتقال دریافتی",
+    "transfer_out": "📤 انتقال ارسالی",
+}
+
+
+class LedgerError(Exception):
+    pass
+
+
+class InsufficientCredit(LedgerError):
+    pass
+
+
+class UnknownUser(LedgerError):
+    pass
+
+
+class DiscountAlreadyUsed(LedgerError):
+    pass
+
+
+class DiscountExpired(LedgerError):
+    pass
+
+
+class DiscountExhausted(LedgerError):
+    pass
+
+
+def post_credit(conn, user_id, delta, kind, ref=None):
+    # فقط داخل تراکنش writer صدا زده می‌شود؛ موجودی هیچ‌وقت منفی نمی‌شود
+    if delta < 0:
+        cur = conn.execute("UPDATE users SET credit = credit + ? WHERE id=? AND credit >= ?", (delta, user_id, -delta))
+    else:
+        cur = conn.execute("UPDATE users SET credit = credit + ? WHERE id=?", (delta, user_id))
+    if cur.rowcount == 0:
+        if conn.execute("SELECT 1 FROM users WHERE id=?", (user_id,)).fetchone():
+            raise InsufficientCredit(user_id)
+        raise UnknownUser(user_id)
+    conn.execute(
+        "INSERT INTO ledger (user_id, delta, kind, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+        (user_id, delta, kind, None if ref is None else str(ref), int(time.time()))
+    )
+
+
+async def transfer_credit(sender, receiver, amount):
+    def transfer(conn):
+        if not conn.execute("SELECT 1 FROM users WHERE id=?", (receiver,)).fetchone():
+            raise UnknownUser(receiver)
+        post_credit(conn, sender, -amount, "transfer_out", receiver)
+        post_credit(conn, receiver, amount, "transfer_in", sender)
+
+    await db.transaction(transfer)
+    user_cache.adjust_credit(sender, -amount)
+    user_cache.adjust_credit(receiver, amount)
+
+
+async def charge_credit(user_id, amount, ref=None):
+    def charge(conn):
+        post_credit(conn, user_id, amount, "charge", ref)
+    await db.transaction(charge)
+    user_cache.adjust_credit(user_id, amount)
+
+
+# مجموعه کدهای تخفیف معتبر در حافظه: حدس‌های اشتباه (و brute-force) بدون مراجعه به دیتابیس رد می‌شوند.
+# در اولین استفاده بارگذاری می‌شود و هر افزودن/حذف کد آن را همزمان به‌روز می‌کند؛ دیتابیس همچنان مرجع نهایی است.
+class DiscountCodeFilter:
+    def __init__(self):
+        self._codes = set()
+        self._loaded = False
+        self._generation = 0
+
+    async def contains(self, code):
+        if not self._loaded:
+            generation = self._generation
+            rows = await db.fetchall("SELECT code FROM codes WHERE max_uses IS NULL OR uses < max_uses")
+            self._codes |= {row[0] for row in rows} # اجتماع (نه جایگزینی) تا کدهای اضافه‌شده در حین بارگذاری گم نشوند
+            self._loaded = generation == self._generation # اگر در حین بارگذاری reload خواسته شد، دوباره خوانده می‌شود
+        return code in self._codes
+
+    def add(self, codes):
+        self._codes.update(codes)
+        publish_invalidation("discount_codes")
+
+    def reload(self):
+        # کدهای جدیدی که یک worker دیگر اضافه کرده در استفاده بعدی از دیتابیس خوانده می‌شوند
+        self._generation += 1
+        self._loaded = False
+
+    def discard(self, code):
+        self._codes.discard(code)
+
+    def __len__(self):
+        return len(self._codes)
+
+
+discount_codes = DiscountCodeFilter()
+
+
+async def redeem_discount(user_id, code):
+    # مقدار کد را برمی‌گرداند؛ None اگر کد نامعتبر باشد
+    if not await discount_codes.contains(code):
+        metrics.inc("bot_discount_rejected_total", reason="filter")
+        return None # کد ناشناخته بدون مراجعه به دیتابیس رد می‌شود
+
+    def redeem(conn):
+        row = conn.execute("SELECT value, max_uses, uses, expires_at FROM codes WHERE code=?", (code,)).fetchone()
+        if not row:
+            return None
+        value, max_uses, uses, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            raise DiscountExpired(code)
+        if conn.execute(
+            "UPDATE codes SET uses = uses + 1 WHERE code=? AND (max_uses IS NULL OR uses < max_uses)", (code,)
+        ).rowcount == 0:
+            raise DiscountExhausted(code)
+        if conn.execute("UPDATE users SET discount_used = 1 WHERE id=? AND discount_used = 0", (user_id,)).rowcount == 0:
+            raise DiscountAlreadyUsed(user_id)
+        post_credit(conn, user_id, value, "discount", code)
+        return value
+
+    try:
+        value = await db.transaction(redeem)
+    except (DiscountExpired, DiscountExhausted):
+        discount_codes.discard(code) # دیگر قابل استفاده نیست؛ تلاش‌های بعدی به دیتابیس نمی‌رسند
+        raise
+    if value is not None:
+        user_cache.adjust_credit(user_id, value)
+        user_cache.update(user_id, discount_used=1)
+    return value
+
+
+# checkpoint دوره‌ای: موجودی کاربرانی که از checkpoint قبلی حرکت داشته‌اند ذخیره می‌شود
+def _checkpoint_balances(conn):
+    last = conn.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM ledger_checkpoints").fetchone()[0]
+    head = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+    if head == last:
+        return 0
+    now = int(time.time())
+    cur = conn.execute(
+        """INSERT INTO balance_snapshots (user_id, ledger_id, balance, created_at)
+        SELECT id, ?, credit, ? FROM users WHERE id IN (SELECT DISTINCT user_id FROM ledger WHERE id > ?)""",
+        (head, now, last)
+    )
+    conn.execute("INSERT INTO ledger_checkpoints (ledger_id, created_at) VALUES (?, ?)", (head, now))
+    return cur.rowcount
+
+
+async def checkpoint_balances(context: ContextTypes.DEFAULT_TYPE):
+    await db.transaction(_checkpoint_balances)
+
+
+# موجودی یک کاربر در زمان at: آخرین snapshot در یا قبل از at به علاوه حرکات همان کاربر بعد از آن snapshot.
+# حرکات بعد از snapshot پس از زمان checkpoint ثبت شده‌اند، پس بازه created_at آن‌ها از دو طرف محدود است
+# و با idx_ledger_user_time فقط چند ردیف خوانده می‌شود (نه کل تاریخچه کاربر).
+async def balance_at(user_id, at):
+    def read(conn):
+        checkpoint = conn.execute(
+            "SELECT MAX(ledger_id) FROM ledger_checkpoints WHERE created_at <= ?", (at,)
+        ).fetchone()[0]
+        snapshot = None
+        if checkpoint is not None:
+            snapshot = conn.execute(
+                """SELECT ledger_id, balance, created_at FROM balance_snapshots
+                WHERE user_id=? AND ledger_id <= ? ORDER BY ledger_id DESC LIMIT 1""",
+                (user_id, checkpoint)
+            ).fetchone()
+        if snapshot is not None:
+            ledger_id, balance, since = snapshot
+            tail = conn.execute(
+                """SELECT COALESCE(SUM(delta), 0) FROM ledger
+                WHERE user_id=? AND created_at >= ? AND created_at <= ? AND id > ?""",
+                (user_id, since, at, ledger_id)
+            ).fetchone()[0]
+            return balance + tail
+        # هنوز snapshot قبل از at وجود ندارد: از موجودی فعلی حرکات بعد از at کم می‌شود
+        row = conn.execute("SELECT credit FROM users WHERE id=?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        later = conn.execute(
+            "SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE user_id=? AND created_at > ?", (user_id, at)
+        ).fetchone()[0]
+        return row[0] - later
+
+    return await db.read(read)
+
+
+# **مسیریاب callbackها**
+# callback_data به شکل فشرده "action:arg1:arg2" کدگذاری می‌شود و فقط یک بار (با کش) به (action, args) تجزیه می‌شود.
+# callbackهای تک‌مرحله‌ای با یک جستجوی dict اجرا می‌شوند و ConversationHandlerها هم به جای regex
+# فقط عضویت action را بررسی می‌کنند.
+CALLBACK_SEPARATOR = ":"
+CALLBACK_DATA_LIMIT = 64 # محدودیت تلگرام (بایت)
+
+# پیشوندهای قدیمی (دکمه‌هایی که قبل از کدگذاری جدید ارسال شده‌اند و هنوز در چت‌ها هستند)
+_LEGACY_CALLBACK_PREFIXES = {
+    "approve_": "approve",
+    "buy_type_": "buy_type",
+    "app_type_": "app_type",
+    "service_type_": "service_type",
+    "admin_add_service_": "admin_add_service",
+}
+
+
+def encode_callback(action, *args):
+    data = CALLBACK_SEPARATOR.join([action, *map(str, args)])
+    if len(data.encode()) > CALLBACK_DATA_LIMIT:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+
+@lru_cache(maxsize=4096)
+def parse_callback(data):
+    if CALLBACK_SEPARATOR not in data:
+        if data.startswith("send_item_to_"): # send_item_to_<user_id>_<item_type>_<item_name>
+            parts = data.split("_")
+            if len(parts) < 6: # دکمه ناقص یا خراب مثل دیگر داده‌های ناشناخته نادیده گرفته می‌شود
+                return data, ()
+            return "send_item", (parts[3], parts[4], " ".join(parts[5:]))
+        for prefix, action in _LEGACY_CALLBACK_PREFIXES.items():
+            if data.startswith(prefix):
+                return action, (data[len(prefix):],)
+    action, *args = data.split(CALLBACK_SEPARATOR)
+    return action, tuple(args)
+
+
+def callback_action(*actions):
+    # pattern برای CallbackQueryHandler: فقط action تجزیه‌شده را با یک مجموعه مقایسه می‌کند
+    actions = frozenset(actions)
+
+    def matches(data):
+        return isinstance(data, str) and parse_callback(data)[0] in actions
+    matches.actions = actions # برای ConversationRouter
+    return matches
+
+
+class CallbackRouter:
+    def __init__(self):
+        self._routes = {} # action -> callback
+
+    def route(self, action, callback):
+        self._routes[action] = callback
+
+    def handler(self):
+        return CallbackQueryHandler(self._dispatch, pattern=self._matches)
+
+    def wrap_routes(self, wrapper):
+        self._routes = {action: wrapper(callback, action) for action, callback in self._routes.items()}
+
+    def _matches(self, data):
+        return isinstance(data, str) and parse_callback(data)[0] in self._routes
+
+    async def _dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        action, _ = parse_callback(update.callback_query.data)
+        return await self._routes[action](update, context)
+
+
+
+# همه ConversationHandlerها پشت یک handler: callback فقط به مکالمه‌هایی داده می‌شود که آن action را در
+# entry_points/states/fallbacks خود دارند (یک جستجوی dict به جای بررسی check_update همه مکالمه‌ها به ترتیب).
+# ترتیب ثبت مکالمه‌ها حفظ می‌شود. updateهای غیر callback (پیام‌ها و دستورها) همچنان به ترتیب به مکالمه‌هایی
+# داده می‌شوند که handler غیر callback دارند (عملاً همه، به خاطر fallback /start).
+class ConversationRouter(BaseHandler):
+    def __init__(self, conversations):
+        super().__init__(self._unused)
+        self.conversations = list(conversations)
+        self._by_action = defaultdict(list) # action -> مکالمه‌ها (به ترتیب ثبت)
+        self._others = [] # مکالمه‌هایی که handler غیر callback دارند
+        for conversation in self.conversations:
+            handlers = conversation.entry_points + conversation.fallbacks + [
+                handler for state_handlers in conversation.states.values() for handler in state_handlers
+            ]
+            for handler in handlers:
+                if isinstance(handler, CallbackQueryHandler):
+                    actions = getattr(handler.pattern, "actions", None)
+                    if actions is None:
+                        raise ValueError(f"{conversation.name}: CallbackQueryHandler pattern must be callback_action(...)")
+                    for action in actions:
+                        if conversation not in self._by_action[action]:
+                            self._by_action[action].append(conversation)
+                elif conversation not in self._others:
+                    self._others.append(conversation)
+
+    @staticmethod
+    async def _unused(update, context):
+        raise RuntimeError("ConversationRouter dispatches to its conversations")
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return None
+        if update.callback_query:
+            data = update.callback_query.data
+            candidates = self._by_action.get(parse_callback(data)[0], ()) if isinstance(data, str) else ()
+        else:
+            candidates = self._others
+        for conversation in candidates:
+            check = conversation.check_update(update)
+            if check is not None and check is not False:
+                return conversation, check
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        conversation, check = check_result
+        return await conversation.handle_update(update, application, check, context)
+
+    async def initialize_persistence(self, application):
+        # Application فقط ConversationHandlerهای سطح اول را به persistence وصل می‌کند؛ مکالمه‌های این router اینجا وصل می‌شوند
+        for conversation in self.conversations:
+            if conversation.persistent:
+                await application._add_ch_to_persistence(conversation)
+
+
+async def initialize_conversation_persistence(application):
+    # باید پس از application.initialize() و پیش از دریافت updateها اجرا شود
+    if application.persistence:
+        for group_handlers in application.handlers.values():
+            for handler in group_handlers:
+                if isinstance(handler, ConversationRouter):
+                    await handler.initialize_persistence(application)
+
+
+def iter_conversations(application):
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            if isinstance(handler, ConversationHandler):
+                yield handler
+            elif isinstance(handler, ConversationRouter):
+                yield from handler.conversations
+
+
+# **جلوگیری از اجرای دوباره callbackها (دو بار زدن دکمه)**
+# کلید هر کلیک (کاربر، callback_data، پیام) است. کلیک تکراری در بازه IDEMPOTENCY_TTL با یک کش در حافظه
+# قبل از هر نوشتن در دیتابیس یا فراخوانی Bot API کنار گذاشته می‌شود. برای عملیات ماندگار (durable) کلید
+# با یک کلید یکتا در جدول callback_claims هم ثبت می‌شود تا بعد از restart یا در workerهای دیگر هم تکرار نشود.
+# اگر handler با خطا تمام شود کلید آزاد می‌شود تا کاربر بتواند دوباره تلاش کند.
+# برای مکالمه‌هایی که کار اصلی در مرحله بعد انجام می‌شود (until_done)، کلید در user_data نگه داشته می‌شود و اگر
+# مکالمه بدون انجام کار تمام شود (خطا یا شروع یک کار دیگر) آزاد می‌شود.
+IDEMPOTENCY_TTL = 60 # ثانیه
+CALLBACK_CLAIM_RETENTION_DAYS = 30
+
+
+class IdempotencyCache:
+    def __init__(self, ttl=IDEMPOTENCY_TTL):
+        self.ttl = ttl
+        self._seen = OrderedDict() # key -> زمان انقضا (به ترتیب ثبت، پس به ترتیب انقضا)
+
+    def claim(self, key):
+        # True اگر این کلید تازه باشد (و حالا ثبت شد)؛ False برای تکراری
+        now = time.monotonic()
+        while self._seen:
+            oldest, expires = next(iter(self._seen.items()))
+            if expires > now:
+                break
+            del self._seen[oldest]
+        if key in self._seen:
+            return False
+        self._seen[key] = now + self.ttl
+        return True
+
+    def release(self, key):
+        self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+idempotency_cache = IdempotencyCache()
+
+
+def callback_key(query):
+    message_id = query.message.message_id if query.message else query.inline_message_id
+    return query.from_user.id, query.data, str(message_id)
+
+
+async def _claim_callback(key):
+    def claim(conn):
+        return conn.execute(
+            "INSERT OR IGNORE INTO callback_claims (user_id, data, message_id, created_at) VALUES (?, ?, ?, ?)",
+            (*key, int(time.time()))
+        ).rowcount == 1
+    return await db.transaction(claim)
+
+
+async def _release_callback(key):
+    await db.execute("DELETE FROM callback_claims WHERE user_id=? AND data=? AND message_id=?", key)
+
+
+async def release_held_claim(context):
+    # کار مکالمه انجام نشد: همان دکمه دوباره قابل استفاده می‌شود
+    key = context.user_data.pop("held_claim", None)
+    if key is not None:
+        key = tuple(key)
+        idempotency_cache.release(key)
+        await _release_callback(key)
+
+
+def finish_held_claim(context):
+    # کار مکالمه انجام شد: کلید برای همیشه (تا prune) ثبت می‌ماند
+    context.user_data.pop("held_claim", None)
+
+
+def idempotent(callback, durable=False, until_done=False):
+    @wraps(callback)
+    async def guarded(update, context):
+        query = update.callback_query
+        key = callback_key(query)
+        fresh = idempotency_cache.claim(key)
+        if fresh and durable:
+            try:
+                fresh = await _claim_callback(key) # False: قبلا (پیش از restart یا در worker دیگر) اجرا شده است
+            except Exception:
+                idempotency_cache.release(key) # خطای دیتابیس: تلاش دوباره کاربر نباید نادیده گرفته شود
+                raise
+        if not fresh:
+            metrics.inc("bot_duplicate_callbacks_total", handler=callback.__name__)
+            try:
+                await query.answer("⏳ این درخواست قبلاً ثبت شده است.")
+            except TelegramError:
+                pass
+            return None # وضعیت مکالمه تغییر نمی‌کند
+        if until_done:
+            await release_held_claim(context) # کار نیمه‌تمام قبلی رها شده است
+        try:
+            result = await callback(update, context)
+        except Exception:
+            idempotency_cache.release(key)
+            if durable:
+                await _release_callback(key)
+            raise
+        if until_done and result not in (None, ConversationHandler.END):
+            context.user_data["held_claim"] = list(key)
+        return result
+    return guarded
+
+
+async def prune_callback_claims(context: ContextTypes.DEFAULT_TYPE):
+    await db.execute("DELETE FROM callback_claims WHERE created_at < ?", (int(time.time()) - CALLBACK_CLAIM_RETENTION_DAYS * 86400,))
 
 
 # /start - شروع مکالمه با ربات
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    # افزودن کاربر به دیتابیس اگر قبلا وجود ندارد
-    cursor.execute("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", (user.id, user.username))
-    conn.commit()
+    # افزودن کاربر به دیتابیس اگر قبلا وجود ندارد (و رفع علامت بلاک اگر کاربر برگشته باشد)
+    await db.execute(
+        "INSERT INTO users (id, username) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET is_blocked = 0 WHERE is_blocked = 1",
+        (user.id, user.username)
+    )
 
     # دکمه‌های Inline (شیشه‌ای) برای تمام قابلیت‌ها
     inline_keyboard_main = [
@@ -100,15 +1228,13 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def my_credit_inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     # ویرایش پیام برای نمایش اعتبار بجای ارسال پیام جدید
-    cursor.execute("SELECT credit FROM users WHERE id=?", (update.callback_query.from_user.id,))
-    credit = cursor.fetchone()[0]
+    credit = (await user_cache.get(update.callback_query.from_user.id)).credit
     await update.callback_query.message.edit_text(f"💳 اعتبار شما: {credit} تومان", reply_markup=None)
 
 async def my_status_inline_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()
     user = update.callback_query.from_user
-    cursor.execute("SELECT credit, discount_used, is_approved FROM users WHERE id=?", (user.id,))
-    credit, discount_used, approved = cursor.fetchone()
+    credit, discount_used, approved = await user_cache.get(user.id)
     status_text = f"""👤 @{user.username}
 🆔 {user.id}
 💳 اعتبار: {credit} تومان
@@ -121,17 +1247,16 @@ async def my_status_inline_handler(update: Update, context: ContextTypes.DEFAULT
 # مرحله اول خرید اکانت: انتخاب نوع اکانت (حالا با دکمه‌های شیشه‌ای)
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    cursor.execute("SELECT is_approved FROM users WHERE id=?", (user_id,))
-    approved = cursor.fetchone()[0]
+    approved = (await user_cache.get(user_id)).is_approved
     if not approved:
         source_message = update.callback_query.message if update.callback_query else update.message
         await source_message.reply_text("⛔ شما هنوز توسط ادمین تأیید نشده‌اید. لطفاً منتظر تأیید بمانید یا درخواست افزایش اعتبار ارسال کنید.")
         return ConversationHandler.END
 
-    options = [[InlineKeyboardButton("1 ماهه", callback_data="buy_type_1_month"),
-                InlineKeyboardButton("3 ماهه", callback_data="buy_type_3_month")],
-               [InlineKeyboardButton("ویژه ❤️", callback_data="buy_type_special"),
-                InlineKeyboardButton("اکسس پوینت 🏠", callback_data="buy_type_access_point")]]
+    options = [[InlineKeyboardButton("1 ماهه", callback_data=encode_callback("buy_type", "1_month")),
+                InlineKeyboardButton("3 ماهه", callback_data=encode_callback("buy_type", "3_month"))],
+               [InlineKeyboardButton("ویژه ❤️", callback_data=encode_callback("buy_type", "special")),
+                InlineKeyboardButton("اکسس پوینت 🏠", callback_data=encode_callback("buy_type", "access_point"))]]
     reply_markup = InlineKeyboardMarkup(options)
     source_message = update.callback_query.message if update.callback_query else update.message
     await source_message.reply_text("لطفاً نوع اکانت را انتخاب کنید:", reply_markup=reply_markup)
@@ -143,30 +1268,30 @@ async def confirm_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user = query.from_user
     # Extract requested account type from callback_data
-    # Callback data format: "buy_type_<type>"
-    requested_account_type = query.data.replace("buy_type_", "").replace("_", " ")
+    # Callback data format: "buy_type:<type>"
+    product = parse_callback(query.data)[1][0]
+    requested_account_type = product.replace("_", " ")
+
+    request_id = await open_request(user.id, "account", product)
+    if request_id is None:
+        await query.message.edit_text(OPEN_ORDER_MESSAGE, reply_markup=None)
+        return ConversationHandler.END
 
-    cursor.execute("UPDATE users SET is_approved = 0 WHERE id=?", (user.id,))
-    conn.commit()
+    # تحویل فوری از موجودی آماده؛ اگر موجودی نباشد درخواست برای ادمین ارسال می‌شود
+    if await fulfil_from_stock(context.bot, user.id, user.username, product, request_id):
+        await query.message.edit_text("✅ اکانت شما ارسال شد.", reply_markup=None)
+        return ConversationHandler.END
 
-    # Generalizing the callback_data for item sending
-    # Format: "send_item_to_<user_id>_<item_type>_<item_name>"
-    inline_keyboard_admin = [
-        [InlineKeyboardButton("✅ ارسال اکانت", callback_data=f"send_item_to_{user.id}_account_{requested_account_type}")]
-    ]
-    reply_markup_admin = InlineKeyboardMarkup(inline_keyboard_admin)
+    # Format: "send_item:<request_id>" (the request row holds the user, item type and product)
+    send_button = InlineKeyboardButton("✅ ارسال اکانت", callback_data=encode_callback("send_item", request_id))
 
     msg_to_admin = (
-        f"🛒 درخواست خرید اکانت جدید:\n"
+        f"🛒 درخواست خرید اکانت جدید (#{request_id}):\n"
         f"کاربر: @{user.username} (ID: {user.id})\n"
         f"نوع اکانت درخواستی: {requested_account_type}\n"
         f"لطفاً اکانت را ارسال کنید:"
     )
-    await context.bot.send_message(
-        chat_id=ADMIN_ID,
-        text=msg_to_admin,
-        reply_markup=reply_markup_admin
-    )
+    await admin_notifier.notify(context.bot, "purchase", msg_to_admin, send_button)
     await query.message.edit_text("✅ درخواست خرید شما به ادمین ارسال شد. لطفاً منتظر دریافت اکانت باشید.", reply_markup=None) # Edit message to remove buttons
     return ConversationHandler.END # پایان مکالمه
 
@@ -174,62 +1299,121 @@ async def confirm_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def get_app(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    keyboard = [[InlineKeyboardButton("📱 اندروید", callback_data="app_type_android"),
-                 InlineKeyboardButton("🍏 آیفون", callback_data="app_type_iphone")],
-                [InlineKeyboardButton("🖥 ویندوز", callback_data="app_type_windows"),
-                 InlineKeyboardButton("❓ راهنمای اتصال", callback_data="app_type_guide")]]
+    keyboard = [[InlineKeyboardButton("📱 اندروید", callback_data=encode_callback("app_type", "android")),
+                 InlineKeyboardButton("🍏 آیفون", callback_data=encode_callback("app_type", "iphone"))],
+                [InlineKeyboardButton("🖥 ویندوز", callback_data=encode_callback("app_type", "windows")),
+                 InlineKeyboardButton("❓ راهنمای اتصال", callback_data=encode_callback("app_type", "guide"))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.reply_text("دستگاه خود را انتخاب کنید:", reply_markup=reply_markup)
     return 2 # حالت برای انتظار پاسخ کاربر
 
+# مسیر پایه برای تصاویر راهنما
+# **مهم:** این مسیر را به مسیر واقعی تصاویر خود تغییر دهید.
+BASE_IMAGE_PATH = os.getenv("GUIDE_IMAGE_PATH", "/home/Vahidfor/Image/")
+
+APP_LINKS = {
+    "android": "https://play.google.com/store/apps/details?id=net.openvpn.openvpn",
+    "iphone": "https://apps.apple.com/app/openvpn-connect/id590379981",
+    "windows": "https://openvpn.net/client-connect-vpn-for-windows/",
+    "guide": {
+        "type": "guide_photos",
+        "files": [
+            f"{BASE_IMAGE_PATH}photo1.jpg", f"{BASE_IMAGE_PATH}photo2.jpg",
+            f"{BASE_IMAGE_PATH}photo3.jpg", f"{BASE_IMAGE_PATH}photo4.jpg",
+            f"{BASE_IMAGE_PATH}photo5.jpg", f"{BASE_IMAGE_PATH}photo6.jpg",
+            f"{BASE_IMAGE_PATH}photo7.jpg", f"{BASE_IMAGE_PATH}photo8.jpg",
+            f"{BASE_IMAGE_PATH}photo9.jpg", f"{BASE_IMAGE_PATH}photo10.jpg",
+        ],
+        "captions": [
+            "1. برنامه OpenVPN را از استور نصب کنید و با زدن دکمه تایید وارد برنامه شوید پس از نصب، برنامه را باز کنید.",
+            "2. روی تب file کلیک کنید .",
+            "3. روی browse کلیک کنید .",
+            "4. پوشه ای که فایل دریافتی را ذخیره کرده اید بروید.",
+            "5. فایل دریافتی را انتخاب و وارد برنامه کنید.",
+            "6. روی ok کلیک کنید.",
+            "7. username و password دریافتی را درقسمت مشخص شده وارد کنید.",
+            "8. درخواست اتصال را تایید کنید.",
+            "9.اگر به متصل نشد روی دکمه کنار فایل کلیک کنید و منتظر بمانید .",
+            "10.پس از اتصال موفقیت‌آمیز، وضعیت را سبز ببینید\nبرای قطع اتصال، دکمه را دوباره فشار دهید\nدر صورت بروز مشکل، ابتدا برنامه را ببندید و دوباره باز کنید\nاگر مشکل ادامه داشت، با پشتیبانی تماس بگیرید\n با آرزوی استفاده عالی از سرویس ما!",
+        ],
+        "additional_note": "نکته : در دستگاه های آیفون(ios) و برخی دستگاه های با اندروید قدیمی لازم است تا ابتدا فایل را باز کرده و با زدن دکمه share و انتخاب نام برنامه آن را وارد برنامه کنید و باقی مراحل را طی کنید.\nدر صورت وجود مشکل با پشتیبانی تماس بگیرید"
+    }
+}
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# کش file_id تصاویر آپلود شده
+# هر فایل فقط یک بار آپلود می‌شود و file_id برگشتی تلگرام در جدول media_cache ذخیره می‌شود.
+# اگر mtime یا اندازه فایل تغییر کند، hash محتوا دوباره بررسی می‌شود و فقط در صورت تغییر واقعی، فایل دوباره آپلود می‌شود.
+class MediaCache:
+    def __init__(self):
+        self._entries = None # path -> (file_id, mtime_ns, size, sha256)
+
+    async def _load(self):
+        if self._entries is None:
+            rows = await db.fetchall("SELECT path, file_id, mtime_ns, size, sha256 FROM media_cache")
+            self._entries = {path: tuple(rest) for path, *rest in rows}
+        return self._entries
+
+    async def get_file_id(self, path):
+        # file_id معتبر برای path یا None اگر هنوز آپلود نشده/فایل تغییر کرده (FileNotFoundError اگر فایل نباشد)
+        entries = await self._load()
+        st = os.stat(path)
+        entry = entries.get(path)
+        if entry is None:
+            return None
+        file_id, mtime_ns, size, digest = entry
+        if (st.st_mtime_ns, st.st_size) == (mtime_ns, size):
+            return file_id
+        if st.st_size == size and await asyncio.to_thread(_file_digest, path) == digest:
+            # فقط زمان فایل عوض شده (مثلا کپی دوباره)؛ file_id هنوز معتبر است
+            await self.store(path, file_id, st, digest)
+            return file_id
+        return None
+
+    async def store(self, path, file_id, st, digest):
+        entries = await self._load()
+        await db.execute(
+            "REPLACE INTO media_cache (path, file_id, mtime_ns, size, sha256) VALUES (?, ?, ?, ?, ?)",
+            (path, file_id, st.st_mtime_ns, st.st_size, digest)
+        )
+        entries[path] = (file_id, st.st_mtime_ns, st.st_size, digest)
+
+
+media_cache = MediaCache()
+
+
 # مرحله دوم دریافت برنامه: ارسال لینک یا راهنمای اتصال (حالا با CallbackQuery)
 async def send_app_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    selected_option_data = query.data.replace("app_type_", "")
-
-    # مسیر پایه برای تصاویر راهنما
-    # **مهم:** این مسیر را به مسیر واقعی تصاویر خود تغییر دهید.
-    BASE_IMAGE_PATH = "/home/Vahidfor/Image/"
-
-    links = {
-        "android": "https://play.google.com/store/apps/details?id=net.openvpn.openvpn",
-        "iphone": "https://apps.apple.com/app/openvpn-connect/id590379981",
-        "windows": "https://openvpn.net/client-connect-vpn-for-windows/",
-        "guide": {
-            "type": "guide_photos",
-            "files": [
-                f"{BASE_IMAGE_PATH}photo1.jpg", f"{BASE_IMAGE_PATH}photo2.jpg",
-                f"{BASE_IMAGE_PATH}photo3.jpg", f"{BASE_IMAGE_PATH}photo4.jpg",
-                f"{BASE_IMAGE_PATH}photo5.jpg", f"{BASE_IMAGE_PATH}photo6.jpg",
-                f"{BASE_IMAGE_PATH}photo7.jpg", f"{BASE_IMAGE_PATH}photo8.jpg",
-                f"{BASE_IMAGE_PATH}photo9.jpg", f"{BASE_IMAGE_PATH}photo10.jpg",
-            ],
-            "captions": [
-                "1. برنامه OpenVPN را از استور نصب کنید و با زدن دکمه تایید وارد برنامه شوید پس از نصب، برنامه را باز کنید.",
-                "2. روی تب file کلیک کنید .",
-                "3. روی browse کلیک کنید .",
-                "4. پوشه ای که فایل دریافتی را ذخیره کرده اید بروید.",
-                "5. فایل دریافتی را انتخاب و وارد برنامه کنید.",
-                "6. روی ok کلیک کنید.",
-                "7. username و password دریافتی را درقسمت مشخص شده وارد کنید.",
-                "8. درخواست اتصال را تایید کنید.",
-                "9.اگر به متصل نشد روی دکمه کنار فایل کلیک کنید و منتظر بمانید .",
-                "10.پس از اتصال موفقیت‌آمیز، وضعیت را سبز ببینید\nبرای قطع اتصال، دکمه را دوباره فشار دهید\nدر صورت بروز مشکل، ابتدا برنامه را ببندید و دوباره باز کنید\nاگر مشکل ادامه داشت، با پشتیبانی تماس بگیرید\n با آرزوی استفاده عالی از سرویس ما!",
-            ],
-            "additional_note": "نکته : در دستگاه های آیفون(ios) و برخی دستگاه های با اندروید قدیمی لازم است تا ابتدا فایل را باز کرده و با زدن دکمه share و انتخاب نام برنامه آن را وارد برنامه کنید و باقی مراحل را طی کنید.\nدر صورت وجود مشکل با پشتیبانی تماس بگیرید"
-        }
-    }
+    selected_option_data = parse_callback(query.data)[1][0]
 
     if selected_option_data == "guide":
-        guide_info = links[selected_option_data]
+        guide_info = APP_LINKS[selected_option_data]
         if guide_info["type"] == "guide_photos":
             media = []
+            uploads = {} # index -> (file_path, stat, sha256) برای فایل‌هایی که هنوز file_id ندارند
             for i, file_path in enumerate(guide_info["files"]):
                 try:
-                    with open(file_path, 'rb') as photo_file:
-                        caption = guide_info["captions"][i] if i < len(guide_info["captions"]) else f"راهنما - عکس {i+1}"
-                        media.append(InputMediaPhoto(media=photo_file.read(), caption=caption))
+                    caption = guide_info["captions"][i] if i < len(guide_info["captions"]) else f"راهنما - عکس {i+1}"
+                    file_id = await media_cache.get_file_id(file_path)
+                    if file_id:
+                        media.append(InputMediaPhoto(media=file_id, caption=caption))
+                    else:
+                        st = os.stat(file_path)
+                        photo_bytes = await asyncio.to_thread(_read_file, file_path)
+                        uploads[i] = (file_path, st, hashlib.sha256(photo_bytes).hexdigest())
+                        media.append(InputMediaPhoto(media=photo_bytes, caption=caption))
                 except FileNotFoundError:
                     await query.message.reply_text(f"خطا: فایل راهنمای {file_path} پیدا نشد. لطفاً از وجود فایل‌ها در مسیر صحیح مطمئن شوید.")
                     return ConversationHandler.END
@@ -239,7 +1423,11 @@ async def send_app_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if media:
                 try:
-                    await query.message.reply_media_group(media=media)
+                    sent_messages = await query.message.reply_media_group(media=media)
+                    # ذخیره file_id فایل‌های تازه آپلود شده برای درخواست‌های بعدی
+                    for i, (file_path, st, digest) in uploads.items():
+                        if i < len(sent_messages) and sent_messages[i].photo:
+                            await media_cache.store(file_path, sent_messages[i].photo[-1].file_id, st, digest)
                     if "additional_note" in guide_info:
                         await query.message.reply_text(guide_info["additional_note"])
                 except Exception as e:
@@ -250,63 +1438,123 @@ async def send_app_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.message.reply_text("فرمت راهنما نامعتبر است.")
     else:
-        await query.message.reply_text(links.get(selected_option_data, "❌ گزینه نامعتبر"))
+        await query.message.reply_text(APP_LINKS.get(selected_option_data, "❌ گزینه نامعتبر"))
 
     await query.message.edit_reply_markup(reply_markup=None) # Remove buttons after selection
     return ConversationHandler.END
 
-# مرحله اول دریافت سرویس‌ها: انتخاب سرویس (حالا با دکمه‌های شیشه‌ای)
-async def get_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    user_id = update.effective_user.id
-    cursor.execute("SELECT is_approved FROM users WHERE id=?", (user_id,))
-    approved = cursor.fetchone()[0]
-    if not approved:
-        await query.message.reply_text("⛔ شما هنوز توسط ادمین تأیید نشده‌اید. لطفاً منتظر تأیید بمانید.")
-        return ConversationHandler.END
+# **کش سرویس‌های ذخیره‌شده**
+# محتوای جدول services (متن/لینک یا file_id که ادمین با save_service ذخیره کرده) یک بار خوانده و در حافظه نگه داشته
+# می‌شود؛ save_service کش را باطل می‌کند. مسیر send_service برای سرویس‌های ذخیره‌شده هیچ خواندنی از دیتابیس ندارد.
+SERVICE_KEYS = { # کلید دکمه کاربر (service_type) -> کلید جدول services (admin_add_service)
+    "OpenVPN": "openvpn",
+    "V2Ray": "v2ray",
+    "Proxy_Telegram": "proxy",
+}
 
-    keyboard = [[InlineKeyboardButton("🔐 OpenVPN", callback_data="service_type_OpenVPN"),
-                 InlineKeyboardButton("🛰 V2Ray", callback_data="service_type_V2Ray")],
-                [InlineKeyboardButton("📡 Proxy تلگرام", callback_data="service_type_Proxy_Telegram")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.message.reply_text("کدام سرویس را می‌خواهید؟", reply_markup=reply_markup)
-    return 3 # حالت برای انتظار پاسخ کاربر
+StoredService = namedtuple("StoredService", ["content", "is_file"])
+
+
+class ServiceCache:
+    def __init__(self):
+        self._services = None # type -> StoredService
+        self._version = 0 # جلوگیری از ذخیره نتیجه کهنه یک بارگذاری همزمان با invalidate
+
+    async def get(self, key):
+        if self._services is None:
+            version = self._version
+            rows = await db.fetchall("SELECT type, content, is_file FROM services")
+            services = {row[0]: StoredService(row[1], bool(row[2])) for row in rows}
+            if version != self._version:
+                return services.get(key)
+            self._services = services
+        return self._services.get(key)
+
+    def invalidate(self):
+        self.clear()
+        publish_invalidation("services")
+
+    def clear(self):
+        self._version += 1
+        self._services = None
+
+
+service_cache = ServiceCache()
+
+
+async def deliver_stored_service(bot, user_id, product):
+    # True اگر سرویس ذخیره‌شده‌ای برای این محصول وجود داشت و ارسال شد
+    service = await service_cache.get(SERVICE_KEYS.get(product))
+    if service is None:
+        return False
+    name = product.replace("_", " ")
+    if service.is_file:
+        await bot.send_document(chat_id=user_id, document=service.content, caption=f"✨ service {name} شما آماده شد!")
+    else:
+        await deliver_item(bot, user_id, "service", name, service.content)
+    metrics.inc("bot_services_delivered_total", product=product, result="delivered")
+    return True
+
+# مرحله اول دریافت سرویس‌ها: انتخاب سرویس (حالا با دکمه‌های شیشه‌ای)
+async def get_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = update.effective_user.id
+    approved = (await user_cache.get(user_id)).is_approved
+    if not approved:
+        await query.message.reply_text("⛔ شما هنوز توسط ادمین تأیید نشده‌اید. لطفاً منتظر تأیید بمانید.")
+        return ConversationHandler.END
+
+    keyboard = [[InlineKeyboardButton("🔐 OpenVPN", callback_data=encode_callback("service_type", "OpenVPN")),
+                 InlineKeyboardButton("🛰 V2Ray", callback_data=encode_callback("service_type", "V2Ray"))],
+                [InlineKeyboardButton("📡 Proxy تلگرام", callback_data=encode_callback("service_type", "Proxy_Telegram"))]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.message.reply_text("کدام سرویس را می‌خواهید؟", reply_markup=reply_markup)
+    return 3 # حالت برای انتظار پاسخ کاربر
 
 # مرحله دوم دریافت سرویس: ارسال درخواست به ادمین (مشابه خرید اکانت)
 async def send_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
-    selected_service_type = query.data.replace("service_type_", "").replace("_", " ")
+    product = parse_callback(query.data)[1][0]
+    selected_service_type = product.replace("_", " ")
 
-    cursor.execute("SELECT is_approved FROM users WHERE id=?", (user.id,))
-    approved = cursor.fetchone()[0]
+    approved = (await user_cache.get(user.id)).is_approved
     if not approved:
         await query.message.reply_text("⛔ در انتظار تأیید توسط ادمین هستید.")
         return ConversationHandler.END
 
-    # Set user to pending approval for this service request
-    cursor.execute("UPDATE users SET is_approved = 0 WHERE id=?", (user.id,))
-    conn.commit()
+    request_id = await open_request(user.id, "service", product)
+    if request_id is None:
+        await query.message.edit_text(OPEN_ORDER_MESSAGE, reply_markup=None)
+        return ConversationHandler.END
+
+    # تحویل فوری: اول آیتم اختصاصی از موجودی آماده، بعد سرویس مشترکی که ادمین ذخیره کرده؛ در غیر این صورت درخواست برای ادمین ارسال می‌شود
+    delivered = await fulfil_from_stock(context.bot, user.id, user.username, product, request_id)
+    if not delivered:
+        try:
+            delivered = await deliver_stored_service(context.bot, user.id, product)
+        except TelegramError as e:
+            # مثلا file_id منقضی‌شده: درخواست باز می‌ماند و مثل قبل برای ادمین ارسال می‌شود
+            print(f"Stored service delivery failed for {product}: {e}")
+            metrics.inc("bot_services_delivered_total", product=product, result="failed")
+        if delivered:
+            await close_request(request_id, "done")
+    if delivered:
+        await query.message.edit_text(f"✅ سرویس '{selected_service_type}' شما ارسال شد.", reply_markup=None)
+        return ConversationHandler.END
 
     # Notify admin to send the service
-    inline_keyboard_admin = [
-        [InlineKeyboardButton("✅ ارسال سرویس", callback_data=f"send_item_to_{user.id}_service_{selected_service_type}")]
-    ]
-    reply_markup_admin = InlineKeyboardMarkup(inline_keyboard_admin)
+    send_button = InlineKeyboardButton("✅ ارسال سرویس", callback_data=encode_callback("send_item", request_id))
 
     msg_to_admin = (
-        f"⚙️ درخواست دریافت سرویس جدید:\n"
+        f"⚙️ درخواست دریافت سرویس جدید (#{request_id}):\n"
         f"کاربر: @{user.username} (ID: {user.id})\n"
         f"نوع سرویس درخواستی: {selected_service_type}\n"
         f"لطفاً سرویس را ارسال کنید:"
     )
-    await context.bot.send_message(
-        chat_id=ADMIN_ID,
-        text=msg_to_admin,
-        reply_markup=reply_markup_admin
-    )
+    await admin_notifier.notify(context.bot, "service", msg_to_admin, send_button)
     await query.message.edit_text(f"✅ درخواست سرویس '{selected_service_type}' شما به ادمین ارسال شد. لطفاً منتظر دریافت سرویس باشید.", reply_markup=None)
     return ConversationHandler.END
 
@@ -322,17 +1570,23 @@ async def apply_discount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     code = update.message.text.strip()
 
-    cursor.execute("SELECT discount_used FROM users WHERE id=?", (user_id,))
-    if cursor.fetchone()[0]:
-        await update.message.reply_text("⛔ شما قبلاً از کد تخفیف استفاده کرده‌اید.", reply_markup=ReplyKeyboardRemove())
+    used_message = "⛔ شما قبلاً از کد تخفیف استفاده کرده‌اید."
+    if (await user_cache.get(user_id)).discount_used:
+        await update.message.reply_text(used_message, reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
 
-    cursor.execute("SELECT value FROM codes WHERE code=?", (code,))
-    row = cursor.fetchone()
-    if row:
-        value = row[0]
-        cursor.execute("UPDATE users SET credit = credit + ?, discount_used = 1 WHERE id=?", (value, user_id))
-        conn.commit()
+    try:
+        value = await redeem_discount(user_id, code)
+    except DiscountAlreadyUsed:
+        await update.message.reply_text(used_message, reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    except DiscountExpired:
+        await update.message.reply_text("❌ این کد تخفیف منقضی شده است.", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    except DiscountExhausted:
+        await update.message.reply_text("❌ ظرفیت استفاده از این کد تخفیف تمام شده است.", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    if value is not None:
         await update.message.reply_text(f"✅ {value} تومان اعتبار اضافه شد.", reply_markup=ReplyKeyboardRemove())
     else:
         await update.message.reply_text("❌ کد تخفیف نامعتبر است.", reply_markup=ReplyKeyboardRemove())
@@ -340,8 +1594,7 @@ async def apply_discount(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # نمایش اعتبار کاربر (مربوط به /score و دکمه شیشه‌ای اعتبار من)
 async def my_credit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cursor.execute("SELECT credit FROM users WHERE id=?", (update.effective_user.id,))
-    credit = cursor.fetchone()[0]
+    credit = (await user_cache.get(update.effective_user.id)).credit
     await update.message.reply_text(f"💳 اعتبار شما: {credit} تومان")
 
 
@@ -366,18 +1619,22 @@ async def ask_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def do_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         amount = int(update.message.text)
+        if amount <= 0:
+            raise ValueError(amount)
         sender = update.effective_user.id
         receiver = context.user_data["target_id"]
 
-        cursor.execute("SELECT credit FROM users WHERE id=?", (sender,))
-        current = cursor.fetchone()[0]
+        current = (await user_cache.get(sender)).credit
         if current < amount:
             await update.message.reply_text("❌ اعتبار شما کافی نیست.", reply_markup=ReplyKeyboardRemove())
-        else:
-            cursor.execute("UPDATE users SET credit = credit - ? WHERE id=?", (amount, sender))
-            cursor.execute("UPDATE users SET credit = credit + ? WHERE id=?", (amount, receiver))
-            conn.commit()
+            return ConversationHandler.END
+        try:
+            await transfer_credit(sender, receiver, amount)
             await update.message.reply_text("✅ انتقال انجام شد.", reply_markup=ReplyKeyboardRemove())
+        except UnknownUser:
+            await update.message.reply_text("❌ کاربر دریافت‌کننده پیدا نشد.", reply_markup=ReplyKeyboardRemove())
+        except InsufficientCredit:
+            await update.message.reply_text("❌ اعتبار شما کافی نیست.", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END # پایان مکالمه
     except ValueError:
         await update.message.reply_text("❌ مقدار اعتبار نامعتبر است. لطفاً یک عدد صحیح وارد کنید.")
@@ -386,8 +1643,7 @@ async def do_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # نمایش وضعیت کاربر (مربوط به /myinfo و دکمه شیشه‌ای وضعیت من)
 async def my_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    cursor.execute("SELECT credit, discount_used, is_approved FROM users WHERE id=?", (user.id,))
-    credit, discount_used, approved = cursor.fetchone()
+    credit, discount_used, approved = await user_cache.get(user.id)
     await update.message.reply_text(f"""👤 @{user.username}
 🆔 {user.id}
 💳 اعتبار: {credit} تومان
@@ -396,6 +1652,47 @@ async def my_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """)
 
 
+# تاریخچه حرکات اعتبار (/history؛ ادمین می‌تواند ID کاربر را هم بدهد: /history 123456789)
+# با تاریخ (/history 2025-06-01 یا /history 123456789 2025-06-01) موجودی پایان آن روز و حرکات تا آن روز نمایش داده می‌شود
+async def credit_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    args = list(context.args or [])
+    at = None
+    if args and "-" in args[-1]:
+        try:
+            at = int(time.mktime(time.strptime(args.pop(), "%Y-%m-%d"))) + 86400 - 1 # پایان همان روز
+        except ValueError:
+            await update.message.reply_text("❌ فرمت تاریخ: /history 2025-06-01")
+            return
+    if args and user_id == ADMIN_ID:
+        try:
+            user_id = int(args[0])
+        except ValueError:
+            await update.message.reply_text("❌ ID کاربر نامعتبر است.")
+            return
+    rows = await db.fetchall(
+        "SELECT delta, kind, ref, created_at FROM ledger WHERE user_id=? AND created_at <= ? "
+        "ORDER BY created_at DESC, id DESC LIMIT ?",
+        (user_id, 2 ** 62 if at is None else at, LEDGER_HISTORY_LIMIT)
+    )
+    lines = []
+    if at is not None:
+        balance = await balance_at(user_id, at)
+        if balance is None:
+            await update.message.reply_text("❌ کاربر پیدا نشد.")
+            return
+        lines.append(f"💳 موجودی در پایان {time.strftime('%Y-%m-%d', time.localtime(at))}: {balance} تومان")
+    if not rows:
+        lines.append("📭 هیچ حرکت اعتباری ثبت نشده است.")
+        await update.message.reply_text("\n".join(lines))
+        return
+    lines.append(f"🧾 آخرین حرکات اعتبار (ID: {user_id}):")
+    for delta, kind, ref, created_at in rows:
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(created_at))
+        lines.append(f"{when} | {LEDGER_KIND_LABELS.get(kind, kind)} | {delta:+} تومان" + (f" ({ref})" if ref else ""))
+    await update.message.reply_text("\n".join(lines))
+
+
 # مرحله اول افزایش اعتبار: پرسیدن جزئیات پرداخت
 async def ask_topup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -406,12 +1703,11 @@ async def ask_topup(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # مرحله دوم افزایش اعتبار: ارسال درخواست به ادمین
 async def send_topup_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    # کاربر را به حالت انتظار تأیید برمی‌گردانیم
-    cursor.execute("UPDATE users SET is_approved = 0 WHERE id=?", (update.effective_user.id,))
-    conn.commit()
+    # درخواست ثبت می‌شود و با شارژ کاربر توسط ادمین بسته می‌شود
+    request_id = await open_request(user.id, "topup", note=update.message.text)
 
-    msg = f"💳 درخواست افزایش اعتبار از:\n@{user.username}\n🆔 {user.id}\n💬 توضیح: {update.message.text}"
-    await context.bot.send_message(chat_id=ADMIN_ID, text=msg) # ارسال پیام به ادمین
+    msg = f"💳 درخواست افزایش اعتبار (#{request_id}) از:\n@{user.username}\n🆔 {user.id}\n💬 توضیح: {update.message.text}"
+    await admin_notifier.notify(context.bot, "topup", msg) # ارسال پیام به ادمین
     await update.message.reply_text("✅ درخواست شما به ادمین ارسال شد. لطفاً منتظر تأیید ادمین بمانید.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END # پایان مکالمه
 
@@ -422,61 +1718,533 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [InlineKeyboardButton("🧾 تأیید کاربران", callback_data="admin_list_pending"),
          InlineKeyboardButton("➕ افزودن کد تخفیف", callback_data="admin_add_discount")],
-        [InlineKeyboardButton("🛰 افزودن سرویس V2Ray", callback_data="admin_add_service_v2ray"),
-         InlineKeyboardButton("🔐 افزودن OpenVPN", callback_data="admin_add_service_openvpn")],
-        [InlineKeyboardButton("📡 افزودن Proxy تلگرام", callback_data="admin_add_service_proxy"),
+        [InlineKeyboardButton("🛰 افزودن سرویس V2Ray", callback_data=encode_callback("admin_add_service", "v2ray")),
+         InlineKeyboardButton("🔐 افزودن OpenVPN", callback_data=encode_callback("admin_add_service", "openvpn"))],
+        [InlineKeyboardButton("📡 افزودن Proxy تلگرام", callback_data=encode_callback("admin_add_service", "proxy")),
          InlineKeyboardButton("💰 شارژ کاربر", callback_data="admin_charge_user")],
-        [InlineKeyboardButton("📢 پیام همگانی", callback_data="admin_broadcast")],
-        [InlineKeyboardButton("✉️ چت با کاربر", callback_data="admin_chat_with_user")] # New button for chat
+        [InlineKeyboardButton("📢 پیام همگانی", callback_data="admin_broadcast"),
+         InlineKeyboardButton("📦 کدهای تخفیف گروهی", callback_data="admin_bulk_codes")],
+        [InlineKeyboardButton("✉️ چت با کاربر", callback_data="admin_chat_with_user"),
+         InlineKeyboardButton("📥 بارگذاری موجودی", callback_data="admin_stock")], # New button for chat
+        [InlineKeyboardButton("📋 درخواست‌های باز", callback_data="orders")]
     ]
-    await update.message.reply_text("🎛 پنل مدیریت:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text(
+        "🎛 پنل مدیریت:\n"
+        "دستورها: /stats /history ID [YYYY-MM-DD] /orders /import_users /export_users /export_ledger",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+# **صف کاربران در انتظار تأیید**
+# لیست با صفحه‌بندی keyset روی ایندکس جزئی idx_users_pending خوانده می‌شود و در یک پیام قابل ویرایش
+# (با دکمه‌های قبلی/بعدی و تأیید همه این صفحه) نمایش داده می‌شود؛ هزینه هر صفحه مستقل از طول صف است.
+PENDING_PAGE_SIZE = 10
+
+
+async def _pending_page(cursor_id, direction):
+    # direction == "next": کاربران با id بزرگتر از cursor_id، direction == "prev": کاربران با id کوچکتر
+    if direction == "prev":
+        rows = await db.fetchall(
+            "SELECT id, username, credit, discount_used FROM users WHERE is_approved=0 AND id < ? ORDER BY id DESC LIMIT ?",
+            (cursor_id, PENDING_PAGE_SIZE + 1)
+        )
+        has_prev = len(rows) > PENDING_PAGE_SIZE
+        rows = rows[:PENDING_PAGE_SIZE][::-1]
+        has_next = bool(rows) and await db.fetchone("SELECT 1 FROM users WHERE is_approved=0 AND id > ? LIMIT 1", (rows[-1][0],)) is not None
+    else:
+        rows = await db.fetchall(
+            "SELECT id, username, credit, discount_used FROM users WHERE is_approved=0 AND id > ? ORDER BY id LIMIT ?",
+            (cursor_id, PENDING_PAGE_SIZE + 1)
+        )
+        has_next = len(rows) > PENDING_PAGE_SIZE
+        rows = rows[:PENDING_PAGE_SIZE]
+        has_prev = bool(rows) and await db.fetchone("SELECT 1 FROM users WHERE is_approved=0 AND id < ? LIMIT 1", (rows[0][0],)) is not None
+    return rows, has_prev, has_next
+
+
+def _render_pending_page(rows, has_prev, has_next):
+    if not rows:
+        return "✅ کاربر در انتظار تأیید وجود ندارد.", None
+    first_id, last_id = rows[0][0], rows[-1][0]
+    lines = ["🧾 کاربران در انتظار تأیید:"]
+    buttons = []
+    for uid, uname, credit, discount_used in rows:
+        discount_text = "استفاده شده" if discount_used else "استفاده نشده"
+        lines.append(f"• @{uname or 'N/A'} | ID: {uid} | اعتبار: {credit} تومان | تخفیف: {discount_text}")
+        buttons.append(InlineKeyboardButton(f"✅ {uid}", callback_data=encode_callback("pending_approve", uid, first_id)))
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("◀️ قبلی", callback_data=encode_callback("pending", "prev", first_id)))
+    if has_next:
+        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=encode_callback("pending", "next", last_id)))
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("✅ تأیید همه این صفحه", callback_data=encode_callback("pending_approve_page", first_id, last_id))])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+PENDING_PAGES_KEPT = 10 # تعداد پیام‌های صفحه‌ای که فهرست کاربرانشان برای «تأیید همه» نگه داشته می‌شود
+
+
+async def _show_pending_page(query, context, cursor_id, direction, edit=True):
+    page = await _pending_page(cursor_id, direction)
+    if not page[0] and direction == "next" and cursor_id > 0:
+        # صفحه آخر خالی شد (مثلا بعد از تأیید)؛ صفحه قبلی نمایش داده می‌شود
+        page = await _pending_page(cursor_id + 1, "prev")
+    text, markup = _render_pending_page(*page)
+    if edit:
+        await query.edit_message_text(text, reply_markup=markup)
+        message_id = query.message.message_id
+    else:
+        message_id = (await query.message.reply_text(text, reply_markup=markup)).message_id
+    # «تأیید همه این صفحه» فقط همین کاربران نمایش‌داده‌شده را تأیید می‌کند (idها ترتیب ثبت‌نام ندارند،
+    # پس بازه id ممکن است کاربری را که بعد از نمایش صفحه ثبت‌نام کرده شامل شود)
+    pages = context.user_data.setdefault("pending_pages", {})
+    pages.pop(str(message_id), None)
+    pages[str(message_id)] = [row[0] for row in page[0]]
+    while len(pages) > PENDING_PAGES_KEPT:
+        del pages[next(iter(pages))]
+
+
+async def _approve_users(bot, uids):
+    for uid in uids:
+        user_cache.update(uid, is_approved=1)
+        try:
+            await bot.send_message(chat_id=uid, text="اکانت شما توسط ادمین تأیید شد. اکنون می‌توانید از خدمات استفاده کنید.")
+        except TelegramError:
+            pass # کاربر ربات را بلاک کرده است
+
 
-# نمایش کاربران در انتظار تأیید (حالا با اطلاعات کامل‌تر و از CallbackQuery)
+# نمایش کاربران در انتظار تأیید (صفحه اول، به صورت یک پیام جدید)
 async def list_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    if query.from_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return
+    await _show_pending_page(query, context, 0, "next", edit=False)
 
-    cursor.execute("SELECT id, username, credit, discount_used, is_approved FROM users WHERE is_approved=0")
-    users = cursor.fetchall()
-    if not users:
-        await query.message.reply_text("✅ کاربر در انتظار تأیید وجود ندارد.")
+# رفتن به صفحه قبلی/بعدی
+async def pending_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
         return
+    direction, cursor_id = parse_callback(query.data)[1]
+    await _show_pending_page(query, context, int(cursor_id), direction)
 
-    for uid, uname, credit, discount_used, is_approved_status in users:
-        status_text = "تأیید شده" if is_approved_status else "در انتظار تأیید"
-        discount_text = "استفاده شده" if discount_used else "استفاده نشده"
-        message_text = (
-            f"درخواست از: @{uname or 'N/A'}\n"
-            f"ID: {uid}\n"
-            f"اعتبار: {credit} تومان\n"
-            f"وضعیت تخفیف: {discount_text}\n"
-            f"وضعیت کلی: {status_text}"
-        )
-        btn = InlineKeyboardMarkup([[InlineKeyboardButton("✅ تأیید", callback_data=f"approve_{uid}")]])
-        await context.bot.send_message(chat_id=ADMIN_ID, text=message_text, reply_markup=btn)
+# تأیید یک کاربر از داخل صفحه و نمایش دوباره همان صفحه
+async def pending_approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer("✅ کاربر تأیید شد.")
+    if query.from_user.id != ADMIN_ID:
+        return
+    uid, first_id = map(int, parse_callback(query.data)[1])
+    await db.execute("UPDATE users SET is_approved=1 WHERE id=?", (uid,))
+    await _show_pending_page(query, context, first_id - 1, "next")
+    await _approve_users(context.bot, [uid])
+
+# تأیید همه کاربران صفحه فعلی در یک تراکنش
+async def pending_approve_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+    first_id, last_id = map(int, parse_callback(query.data)[1])
+    shown = context.user_data.get("pending_pages", {}).get(str(query.message.message_id))
+    if shown is None: # صفحه قدیمی که فهرستش دیگر نگه داشته نمی‌شود: فقط دوباره نمایش داده می‌شود
+        await _show_pending_page(query, context, first_id - 1, "next")
+        return
+
+    def approve_page(conn):
+        return [
+            uid for uid in shown
+            if conn.execute("UPDATE users SET is_approved=1 WHERE id=? AND is_approved=0", (uid,)).rowcount
+        ]
+
+    uids = await db.transaction(approve_page)
+    await _show_pending_page(query, context, first_id - 1, "next")
+    await _approve_users(context.bot, uids)
 
 # تأیید کاربر توسط ادمین
 async def approve_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    uid = int(query.data.split("_")[1])
-    cursor.execute("UPDATE users SET is_approved=1 WHERE id=?", (uid,))
-    conn.commit()
+    if query.from_user.id != ADMIN_ID:
+        return
+    uid = int(parse_callback(query.data)[1][0])
+    await db.execute("UPDATE users SET is_approved=1 WHERE id=?", (uid,))
     await query.edit_message_text("✅ کاربر تأیید شد.")
-    await context.bot.send_message(chat_id=uid, text="اکانت شما توسط ادمین تأیید شد. اکنون می‌توانید از خدمات استفاده کنید.")
+    await _approve_users(context.bot, [uid])
+
+# **درخواست‌ها (سفارش اکانت/سرویس و افزایش اعتبار)**
+# هر سفارش یا درخواست افزایش اعتبار یک ردیف در جدول requests است (open -> done/rejected/cancelled)؛
+# is_approved فقط تأیید اولیه کاربر است و دیگر با هر سفارش صفر نمی‌شود. هر کاربر حداکثر یک سفارش باز
+# (اکانت/سرویس) دارد که ایندکس یکتای جزئی idx_requests_one_open آن را تضمین می‌کند. ادمین با /orders
+# درخواست‌های باز هر نوع را صفحه به صفحه (روی ایندکس جزئی idx_requests_open) می‌بیند و پردازش می‌کند.
+REQUEST_KIND_LABELS = {"account": "🛒 اکانت", "service": "⚙️ سرویس", "topup": "💳 افزایش اعتبار"}
+REQUEST_STATUS_LABELS = {"open": "⏳ باز", "done": "✅ انجام شد", "rejected": "❌ رد شد", "cancelled": "↩️ لغو شد"}
+ORDERS_PAGE_SIZE = 10
+ORDERS_HISTORY_LIMIT = 20
+OPEN_ORDER_MESSAGE = "⏳ شما یک سفارش باز دارید. لطفاً تا انجام شدن آن توسط ادمین صبر کنید."
+
+
+async def open_request(user_id, kind, product=None, note=None):
+    # شناسه درخواست جدید؛ None اگر کاربر از قبل یک سفارش باز داشته باشد
+    def insert(conn):
+        now = int(time.time())
+        try:
+            return conn.execute(
+                "INSERT INTO requests (user_id, kind, product, note, status, created_at, updated_at) VALUES (?, ?, ?, ?, 'open', ?, ?)",
+                (user_id, kind, product, note, now, now)
+            ).lastrowid
+        except sqlite3.IntegrityError:
+            return None
+    request_id = await db.transaction(insert)
+    metrics.inc("bot_requests_total", kind=kind, result="opened" if request_id else "duplicate")
+    return request_id
+
+
+def _close_request(conn, request_id, status, handled_by=None):
+    return conn.execute(
+        "UPDATE requests SET status=?, handled_by=?, updated_at=? WHERE id=? AND status='open'",
+        (status, handled_by, int(time.time()), request_id)
+    ).rowcount == 1
+
+
+async def close_request(request_id, status, handled_by=None):
+    # True اگر درخواست باز بود و حالا بسته شد
+    def close(conn):
+        return _close_request(conn, request_id, status, handled_by)
+    return await db.transaction(close)
+
+
+async def close_user_requests(user_id, kind, handled_by=None):
+    await db.execute(
+        "UPDATE requests SET status='done', handled_by=?, updated_at=? WHERE user_id=? AND kind=? AND status='open'",
+        (handled_by, int(time.time()), user_id, kind)
+    )
+
+
+def _request_age(created_at):
+    minutes = max(0, int(time.time()) - created_at) // 60
+    if minutes < 60:
+        return f"{minutes} دقیقه"
+    if minutes < 1440:
+        return f"{minutes // 60} ساعت"
+    return f"{minutes // 1440} روز"
+
+
+async def _orders_summary():
+    rows = await db.fetchall("SELECT kind, COUNT(*) FROM requests WHERE status='open' GROUP BY kind")
+    counts = dict(rows)
+    keyboard = [
+        [InlineKeyboardButton(f"{label} ({counts.get(kind, 0)})", callback_data=encode_callback("orders_page", kind, 0))]
+        for kind, label in REQUEST_KIND_LABELS.items()
+    ]
+    return "📋 درخواست‌های باز (برای جستجوی درخواست‌های یک کاربر: /orders ID):", InlineKeyboardMarkup(keyboard)
+
+
+async def _orders_page(kind, cursor_id):
+    rows = await db.fetchall(
+        """SELECT r.id, r.user_id, u.username, r.product, r.note, r.created_at FROM requests r
+        LEFT JOIN users u ON u.id = r.user_id
+        WHERE r.status='open' AND r.kind=? AND r.id > ? ORDER BY r.id LIMIT ?""",
+        (kind, cursor_id, ORDERS_PAGE_SIZE + 1)
+    )
+    has_next = len(rows) > ORDERS_PAGE_SIZE
+    rows = rows[:ORDERS_PAGE_SIZE]
+    if not rows:
+        return f"✅ درخواست باز {REQUEST_KIND_LABELS[kind]} وجود ندارد.", None
+    first_id, last_id = rows[0][0], rows[-1][0]
+    lines = [f"📋 درخواست‌های باز {REQUEST_KIND_LABELS[kind]}:"]
+    keyboard = []
+    for request_id, uid, uname, product, note, created_at in rows:
+        detail = (product or "").replace("_", " ") if kind != "topup" else (note or "")[:80]
+        lines.append(f"• #{request_id} | @{uname or 'N/A'} | ID: {uid} | {detail} | {_request_age(created_at)} پیش")
+        if kind == "topup": # با شارژ کاربر (💰 شارژ کاربر) خودکار بسته می‌شود
+            action = InlineKeyboardButton(f"✅ #{request_id}", callback_data=encode_callback("order_close", request_id, "done"))
+        else:
+            action = InlineKeyboardButton(f"📤 #{request_id}", callback_data=encode_callback("send_item", request_id))
+        keyboard.append([action, InlineKeyboardButton(f"❌ #{request_id}", callback_data=encode_callback("order_close", request_id, "rejected"))])
+    nav = []
+    if cursor_id > 0:
+        nav.append(InlineKeyboardButton("⏮ ابتدا", callback_data=encode_callback("orders_page", kind, 0)))
+    if has_next:
+        nav.append(InlineKeyboardButton("بعدی ▶️", callback_data=encode_callback("orders_page", kind, last_id)))
+    if nav:
+        keyboard.append(nav)
+    if kind != "topup":
+        keyboard.append([InlineKeyboardButton("📦 تحویل این صفحه از موجودی", callback_data=encode_callback("orders_stock", kind, first_id, last_id))])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+async def _user_requests(uid):
+    rows = await db.fetchall(
+        "SELECT id, kind, product, note, status, created_at FROM requests WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (uid, ORDERS_HISTORY_LIMIT)
+    )
+    if not rows:
+        return f"کاربر ID: {uid} هیچ درخواستی ندارد."
+    lines = [f"📋 آخرین درخواست‌های کاربر ID: {uid}:"]
+    for request_id, kind, product, note, status, created_at in rows:
+        detail = (product or "").replace("_", " ") if kind != "topup" else (note or "")[:80]
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(created_at))
+        lines.append(f"• #{request_id} | {REQUEST_KIND_LABELS.get(kind, kind)} {detail} | {REQUEST_STATUS_LABELS.get(status, status)} | {when}")
+    return "\n".join(lines)
+
+
+# /orders [account|service|topup|ID] - درخواست‌های باز (ادمین)
+async def orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    arg = context.args[0] if context.args else None
+    if arg is None:
+        text, markup = await _orders_summary()
+    elif arg in REQUEST_KIND_LABELS:
+        text, markup = await _orders_page(arg, 0)
+    elif arg.isdigit():
+        text, markup = await _user_requests(int(arg)), None
+    else:
+        text, markup = "استفاده: /orders [account|service|topup|ID]", None
+    await update.message.reply_text(text, reply_markup=markup)
+
+# دکمه «درخواست‌های باز» پنل ادمین
+async def orders_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+    text, markup = await _orders_summary()
+    await query.message.reply_text(text, reply_markup=markup)
+
+# نمایش یک صفحه از درخواست‌های باز یک نوع
+async def orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+    kind, cursor_id = parse_callback(query.data)[1]
+    if kind not in REQUEST_KIND_LABELS:
+        return
+    text, markup = await _orders_page(kind, int(cursor_id))
+    await query.edit_message_text(text, reply_markup=markup)
+
+# بستن دستی یک درخواست (رد سفارش یا انجام افزایش اعتبار)
+async def order_close(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id != ADMIN_ID:
+        return await query.answer()
+    request_id, status = parse_callback(query.data)[1]
+    request_id = int(request_id)
+    if status not in ("done", "rejected"):
+        return await query.answer()
+    row = await db.fetchone("SELECT user_id, kind FROM requests WHERE id=?", (request_id,))
+    if row is None or not await close_request(request_id, status, query.from_user.id):
+        return await query.answer("این درخواست قبلاً بسته شده است.")
+    await query.answer(f"#{request_id}: {REQUEST_STATUS_LABELS[status]}")
+    if status == "rejected":
+        try:
+            await context.bot.send_message(chat_id=row[0], text=f"❌ درخواست #{request_id} شما توسط ادمین رد شد. برای اطلاعات بیشتر با پشتیبانی در تماس باشید.")
+        except TelegramError:
+            pass # کاربر ربات را بلاک کرده است
+    text, markup = await _orders_page(row[1], 0)
+    await query.edit_message_text(text, reply_markup=markup)
+
+# تحویل همه سفارش‌های این صفحه از موجودی آماده (سفارش‌هایی که موجودی ندارند باز می‌مانند)
+async def orders_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+    kind, first_id, last_id = parse_callback(query.data)[1]
+    rows = await db.fetchall(
+        """SELECT r.id, r.user_id, u.username, r.product FROM requests r LEFT JOIN users u ON u.id = r.user_id
+        WHERE r.status='open' AND r.kind=? AND r.id BETWEEN ? AND ? ORDER BY r.id""",
+        (kind, int(first_id), int(last_id))
+    )
+    delivered = failed = 0
+    for request_id, uid, uname, product in rows:
+        try:
+            delivered += await fulfil_from_stock(context.bot, uid, uname, product, request_id)
+        except TelegramError:
+            failed += 1 # کاربر ربات را بلاک کرده؛ آیتم به موجودی برگشت و سفارش لغو شد
+    text, markup = await _orders_page(kind, int(first_id) - 1)
+    await query.edit_message_text(text, reply_markup=markup)
+    summary = f"📦 {delivered} سفارش از موجودی تحویل شد؛ {len(rows) - delivered - failed} سفارش منتظر موجودی یا ارسال دستی است."
+    if failed:
+        summary += f"\n⚠️ {failed} سفارش به دلیل خطا در ارسال لغو شد."
+    await query.message.reply_text(summary)
+
+# **اشتراک‌های زمان‌دار (یادآوری تمدید و انقضا)**
+# تحویل یک اکانت زمان‌دار (از موجودی یا توسط ادمین) یک اشتراک می‌سازد، یا اگر کاربر اشتراک فعال همان محصول را
+# داشته باشد آن را تمدید می‌کند. هر اشتراک فعال یک موعد بعدی (due_at) دارد: یادآوری چند روز قبل از انقضا و سپس انقضا.
+# زمان‌بند یک min-heap از نزدیک‌ترین موعدها را به صورت دسته‌ای از ایندکس idx_subscriptions_due بارگذاری می‌کند و فقط
+# برای سر heap یک job در job_queue نگه می‌دارد؛ هیچ پیمایش دوره‌ای روی کل جدول انجام نمی‌شود.
+# ورودی‌های کهنه heap (اشتراک تمدیدشده) هنگام اجرا با مقایسه due_at دیتابیس کنار گذاشته می‌شوند.
+SUBSCRIPTION_DAYS = {"1_month": 30, "3_month": 90} # محصولات زمان‌دار
+SUBSCRIPTION_REMIND_DAYS = int(os.getenv("SUBSCRIPTION_REMIND_DAYS", "3"))
+SUBSCRIPTION_HEAP_BATCH = 1000 # تعداد موعدهای بارگذاری‌شده در هر بار خواندن از دیتابیس
+
+
+def _subscription_due(expires_at, now):
+    remind_at = expires_at - SUBSCRIPTION_REMIND_DAYS * 86400
+    return ("remind", remind_at) if remind_at > now else ("expire", expires_at)
+
+
+def _start_subscription(conn, request_id):
+    # (due_at, id) اشتراک ساخته/تمدیدشده؛ None اگر درخواست یک اکانت زمان‌دار نباشد
+    row = conn.execute("SELECT user_id, kind, product FROM requests WHERE id=?", (request_id,)).fetchone()
+    if row is None or row[1] != "account" or row[2] not in SUBSCRIPTION_DAYS:
+        return None
+    user_id, _, product = row
+    now = int(time.time())
+    duration = SUBSCRIPTION_DAYS[product] * 86400
+    active = conn.execute(
+        "SELECT id, expires_at FROM subscriptions WHERE user_id=? AND product=? AND status='active' ORDER BY expires_at DESC LIMIT 1",
+        (user_id, product)
+    ).fetchone()
+    if active is not None: # تمدید: مدت جدید به انتهای اشتراک فعلی اضافه می‌شود
+        sub_id, expires_at = active[0], max(active[1], now) + duration
+        stage, due_at = _subscription_due(expires_at, now)
+        conn.execute(
+            "UPDATE subscriptions SET expires_at=?, stage=?, due_at=?, request_id=? WHERE id=?",
+            (expires_at, stage, due_at, request_id, sub_id)
+        )
+    else:
+        expires_at = now + duration
+        stage, due_at = _subscription_due(expires_at, now)
+        sub_id = conn.execute(
+            "INSERT INTO subscriptions (user_id, product, request_id, starts_at, expires_at, stage, due_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, product, request_id, now, expires_at, stage, due_at)
+        ).lastrowid
+    return due_at, sub_id
+
+
+async def start_subscription(request_id):
+    def start_sub(conn):
+        return _start_subscription(conn, request_id)
+    due = await db.transaction(start_sub)
+    if due is not None:
+        subscription_scheduler.push(*due)
+        metrics.inc("bot_subscriptions_started_total")
+
+
+class SubscriptionScheduler:
+    def __init__(self, batch=SUBSCRIPTION_HEAP_BATCH):
+        self.batch = batch
+        self._heap = [] # (due_at, subscription_id)
+        self._horizon = None # آخرین (due_at, id) بارگذاری‌شده؛ None یعنی همه موعدهای بعدی در heap هستند
+        self._job_queue = None # فقط در پردازشی که زمان‌بند را اجرا می‌کند
+        self._job = None
+        self._job_due = None
+        self._running = False
+        self.limiter = None
+
+    async def start(self, job_queue):
+        self._job_queue = job_queue
+        self.limiter = RateLimiter(BROADCAST_RATE)
+        await self._load()
+        self._arm()
+
+    async def _load(self):
+        sql = "SELECT due_at, id FROM subscriptions WHERE due_at IS NOT NULL"
+        params = ()
+        if self._horizon is not None:
+            sql += " AND (due_at, id) > (?, ?)"
+            params = self._horizon
+        rows = await db.fetchall(sql + " ORDER BY due_at, id LIMIT ?", (*params, self.batch))
+        for row in rows:
+            heapq.heappush(self._heap, tuple(row))
+        self._horizon = tuple(rows[-1]) if len(rows) == self.batch else None
+
+    def _needs_load(self):
+        # موعدهای دیتابیس بین horizon و سر heap هنوز بارگذاری نشده‌اند
+        return self._horizon is not None and (not self._heap or self._heap[0] > self._horizon)
+
+    def push(self, due_at, sub_id, publish=True):
+        if publish: # در حالت چند پردازشی زمان‌بند فقط در worker اول اجرا می‌شود
+            publish_invalidation("subscription", (due_at, sub_id))
+        if self._job_queue is None:
+            return
+        if self._horizon is not None and (due_at, sub_id) > self._horizon:
+            return # بعد از رسیدن به horizon از دیتابیس خوانده می‌شود
+        heapq.heappush(self._heap, (due_at, sub_id))
+        self._arm()
+
+    def _arm(self):
+        # یک job برای نزدیک‌ترین موعد؛ اگر موعد جدید زودتر باشد job قبلی جایگزین می‌شود
+        if self._running or not (self._heap or self._horizon):
+            return
+        # اگر باید از دیتابیس بارگذاری شود، job فورا (در موعد horizon) اجرا می‌شود تا _fire بارگذاری کند
+        due_at = self._horizon[0] if self._needs_load() else self._heap[0][0]
+        if self._job is not None:
+            if self._job_due <= due_at:
+                return
+            self._job.schedule_removal()
+        self._job_due = due_at
+        self._job = self._job_queue.run_once(self._fire, when=max(0, due_at - time.time()), name="subscriptions")
+
+    async def _fire(self, context: ContextTypes.DEFAULT_TYPE):
+        self._job = self._job_due = None
+        self._running = True
+        try:
+            now = time.time()
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < self.batch:
+                due.append(heapq.heappop(self._heap))
+            if due:
+                await self._process(context.bot, due)
+            if self._needs_load():
+                await self._load()
+        finally:
+            self._running = False
+            self._arm()
+
+    async def _process(self, bot, due):
+        def advance_subscriptions(conn):
+            events = []
+            now = int(time.time())
+            for due_at, sub_id in due:
+                row = conn.execute(
+                    "SELECT user_id, product, expires_at, stage FROM subscriptions WHERE id=? AND due_at=?", (sub_id, due_at)
+                ).fetchone()
+                if row is None:
+                    continue # ورودی کهنه: اشتراک تمدید شده یا قبلا پردازش شده است
+                user_id, product, expires_at, stage = row
+                if stage == "remind" and expires_at > now:
+                    conn.execute("UPDATE subscriptions SET stage='expire', due_at=? WHERE id=?", (expires_at, sub_id))
+                    events.append(("remind", sub_id, user_id, product, expires_at))
+                else:
+                    conn.execute("UPDATE subscriptions SET status='expired', stage=NULL, due_at=NULL WHERE id=?", (sub_id,))
+                    events.append(("expire", sub_id, user_id, product, expires_at))
+            return events
+
+        renew = InlineKeyboardMarkup([[InlineKeyboardButton("🔄 تمدید اشتراک", callback_data="buy_account")]])
+        for event, sub_id, user_id, product, expires_at in await db.transaction(advance_subscriptions):
+            name = product.replace("_", " ")
+            if event == "remind":
+                self.push(expires_at, sub_id, publish=False)
+                days = max(1, round((expires_at - time.time()) / 86400))
+                text = f"⏰ اشتراک {name} شما {days} روز دیگر به پایان می‌رسد. برای قطع نشدن سرویس، آن را تمدید کنید."
+            else:
+                text = f"⌛ اشتراک {name} شما به پایان رسید. برای ادامه استفاده، اشتراک جدید تهیه کنید."
+                await admin_notifier.notify(bot, "expiry", f"⌛ اشتراک {name} کاربر ID: {user_id} منقضی شد (اشتراک #{sub_id}).")
+            metrics.inc("bot_subscription_events_total", event=event)
+            await _broadcast_send(bot, self.limiter, user_id, text, renew)
+
+    def __len__(self):
+        return len(self._heap)
+
+
+subscription_scheduler = SubscriptionScheduler()
+
 
 # مرحله اول افزودن سرویس (توسط ادمین - حالا از CallbackQuery)
 async def ask_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    text = query.data # e.g., admin_add_service_v2ray
-    mapping = {
-        "admin_add_service_v2ray": "v2ray",
-        "admin_add_service_openvpn": "openvpn",
-        "admin_add_service_proxy": "proxy"
-    }
-    key = mapping.get(text)
-    if not key:
+    key = parse_callback(query.data)[1][0] # e.g., admin_add_service:v2ray
+    if key not in ("v2ray", "openvpn", "proxy"):
         return # Should not happen with correct callback data
     context.user_data["servicetype"] = key # ذخیره نوع سرویس در context
     await query.message.reply_text("لطفاً لینک، متن سرویس را وارد کنید یا **فایل مربوطه را ارسال نمایید:**", reply_markup=ReplyKeyboardRemove())
@@ -501,65 +2269,610 @@ async def save_service(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END # پایان مکالمه (می‌توانید حالت را نگه دارید تا ادمین دوباره تلاش کند)
 
     if content_to_save: # اگر محتوایی برای ذخیره وجود داشت
-        cursor.execute("REPLACE INTO services (type, content, is_file) VALUES (?, ?, ?)", (s_type, content_to_save, is_file_flag))
-        conn.commit()
+        await db.execute("REPLACE INTO services (type, content, is_file) VALUES (?, ?, ?)", (s_type, content_to_save, is_file_flag))
+        service_cache.invalidate()
     return ConversationHandler.END # پایان مکالمه
 
 # مرحله اول افزودن کد تخفیف (توسط ادمین - حالا از CallbackQuery)
 async def ask_discount_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    await query.message.reply_text("کد و مقدار را وارد کن (مثال: vip50 5000):", reply_markup=ReplyKeyboardRemove())
+    await query.message.reply_text(
+        "کد و مقدار را وارد کن (مثال: vip50 5000)\n"
+        "اختیاری: حداکثر تعداد استفاده و تعداد روز اعتبار (مثال: vip50 5000 100 30)",
+        reply_markup=ReplyKeyboardRemove()
+    )
     return 9 # حالت برای انتظار پاسخ ادمین
 
 # مرحله دوم افزودن کد تخفیف: ذخیره کد در دیتابیس
 async def save_discount_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        code, val = update.message.text.strip().split()
-        cursor.execute("INSERT INTO codes (code, value) VALUES (?, ?)", (code, int(val)))
-        conn.commit()
+        code, val, *limits = update.message.text.strip().split()
+        if len(limits) > 2:
+            raise ValueError(limits)
+        max_uses, days = (limits + [None, None])[:2]
+        await db.execute(
+            "INSERT INTO codes (code, value, max_uses, expires_at) VALUES (?, ?, ?, ?)",
+            (code, int(val), _positive_or_none(max_uses), _expiry_from_days(days))
+        )
+        discount_codes.add([code])
         await update.message.reply_text("✅ کد اضافه شد.", reply_markup=ReplyKeyboardRemove())
     except:
         await update.message.reply_text("❌ فرمت اشتباه.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END # پایان مکالمه
 
-# مرحله اول شارژ کاربر (توسط ادمین - حالا از CallbackQuery)
-async def ask_charge(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.message.reply_text("ID کاربر و مبلغ (مثال: 123456789 10000):", reply_markup=ReplyKeyboardRemove())
-    return 10 # حالت برای انتظار پاسخ ادمین
 
-# مرحله دوم شارژ کاربر: انجام شارژ
-async def do_charge(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        uid, amount = update.message.text.strip().split()
-        cursor.execute("UPDATE users SET credit = credit + ? WHERE id=?", (int(amount), int(uid)))
-        conn.commit()
-        await update.message.reply_text("✅ شارژ شد.", reply_markup=ReplyKeyboardRemove())
-    except:
-        await update.message.reply_text("❌ خطا در ورودی.", reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END # پایان مکالمه
+# **کدهای تخفیف گروهی**
+# ادمین می‌تواند ده‌ها هزار کد را یکجا بسازد یا از یک فایل CSV وارد کند؛ همه کدها در یک تراکنش نوشته می‌شوند.
+BULK_CODES = 16 # حالت مکالمه ادمین
+BULK_CODES_MAX = 100000
+DISCOUNT_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789" # بدون حروف مشابه (O/0، I/1)
+DISCOUNT_CODE_LENGTH = 8
+
+
+def _positive_or_none(value):
+    if value in (None, "", "-"):
+        return None
+    value = int(value)
+    if value <= 0:
+        raise ValueError(value)
+    return value
+
+
+def _expiry_from_days(days):
+    days = _positive_or_none(days)
+    return None if days is None else int(time.time()) + days * 86400
+
+
+def _expiry_from_date(text):
+    # تاریخ به صورت YYYY-MM-DD؛ کد تا پایان آن روز معتبر است
+    if not text:
+        return None
+    return int(time.mktime(time.strptime(text, "%Y-%m-%d"))) + 86400
+
+
+def generate_discount_codes(count, prefix=""):
+    codes = set()
+    while len(codes) < count:
+        codes.add(prefix + "".join(secrets.choice(DISCOUNT_CODE_ALPHABET) for _ in range(DISCOUNT_CODE_LENGTH)))
+    return list(codes)
+
+
+def parse_codes_csv(data):
+    # ستون‌ها: code,value[,max_uses][,expires (YYYY-MM-DD)] - سطر عنوان اختیاری است
+    rows = []
+    for line_number, row in enumerate(csv.reader(io.StringIO(data.decode("utf-8-sig"))), start=1):
+        row = [cell.strip() for cell in row]
+        if not row or not row[0]:
+            continue
+        if line_number == 1 and len(row) > 1 and not row[1].lstrip("-").isdigit():
+            continue # سطر عنوان
+        try:
+            code, value, max_uses, expires = (row + ["", ""])[:4]
+            if not code or len(row) > 4:
+                raise ValueError(row)
+            rows.append((code, int(value), _positive_or_none(max_uses), _expiry_from_date(expires)))
+        except ValueError:
+            raise ValueError(line_number)
+    return rows
+
+
+def codes_csv(codes, value, max_uses, expires_at):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["code", "value", "max_uses", "expires_at"])
+    expires = time.strftime("%Y-%m-%d", time.localtime(expires_at)) if expires_at else ""
+    writer.writerows((code, value, max_uses or "", expires) for code in codes)
+    return output.getvalue().encode()
+
+
+async def store_discount_codes(rows, replace):
+    # همه کدها در یک تراکنش؛ در حالت replace (ورود CSV) مقدار و محدودیت کدهای موجود به‌روز می‌شود
+    # کدهایی که واقعاً ذخیره یا به‌روز شدند برگردانده می‌شوند (بدون replace، کدهای تکراری کنار گذاشته می‌شوند)
+    sql = (
+        "INSERT INTO codes (code, value, max_uses, expires_at) VALUES (?, ?, ?, ?) "
+        + ("ON CONFLICT(code) DO UPDATE SET value=excluded.value, max_uses=excluded.max_uses, expires_at=excluded.expires_at"
+           if replace else "ON CONFLICT(code) DO NOTHING")
+    )
+
+    def store(conn):
+        if replace:
+            conn.executemany(sql, rows)
+            return [row[0] for row in rows]
+        stored = []
+        for row in rows:
+            before = conn.total_changes # rowcount برای INSERT ... DO NOTHING قابل اعتماد نیست
+            conn.execute(sql, row)
+            if conn.total_changes != before:
+                stored.append(row[0])
+        return stored
+
+    stored = await db.transaction(store)
+    discount_codes.add(stored)
+    return stored
+
+
+# مرحله اول کدهای گروهی (توسط ادمین)
+async def ask_bulk_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return ConversationHandler.END
+    await query.message.reply_text(
+        "📦 کدهای تخفیف گروهی:\n"
+        "• ساخت: تعداد مقدار [حداکثر استفاده هر کد] [روز اعتبار] [پیشوند]\n"
+        "  مثال: 10000 5000 1 30 NY\n"
+        "• ورود: فایل CSV با ستون‌های code,value,max_uses,expires (تاریخ به شکل 2025-12-31؛ دو ستون آخر اختیاری)",
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return BULK_CODES
+
+# مرحله دوم کدهای گروهی: ساخت یا ورود و ذخیره در یک تراکنش
+async def save_bulk_codes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.document:
+        data = await (await update.message.document.get_file()).download_as_bytearray()
+        try:
+            rows = await asyncio.to_thread(parse_codes_csv, bytes(data)) # فایل‌های بزرگ event loop را متوقف نمی‌کنند
+        except (ValueError, UnicodeDecodeError) as e:
+            line = f" (سطر {e.args[0]})" if isinstance(e, ValueError) and e.args else ""
+            await update.message.reply_text(f"❌ فایل CSV نامعتبر است{line}. هیچ کدی ذخیره نشد.")
+            return ConversationHandler.END
+        if not rows or len(rows) > BULK_CODES_MAX:
+            await update.message.reply_text(f"❌ فایل باید بین 1 و {BULK_CODES_MAX} کد داشته باشد.")
+            return ConversationHandler.END
+        stored = await store_discount_codes(rows, replace=True)
+        await update.message.reply_text(f"✅ {len(stored)} کد از {len(rows)} ردیف فایل ذخیره یا به‌روز شد.")
+        return ConversationHandler.END
+
+    try:
+        count, value, *rest = update.message.text.split()
+        if len(rest) > 3:
+            raise ValueError(rest)
+        max_uses, days, prefix = (rest + [None, None, None])[:3]
+        prefix = prefix or ""
+        count, value = int(count), int(value)
+        if not 0 < count <= BULK_CODES_MAX:
+            raise ValueError(count)
+        max_uses, expires_at = _positive_or_none(max_uses), _expiry_from_days(days)
+    except ValueError:
+        await update.message.reply_text("❌ فرمت اشتباه.")
+        return ConversationHandler.END
+
+    # ساخت و نوشتن CSV چند صد هزار کد در thread جدا انجام می‌شود تا event loop متوقف نشود
+    codes = await asyncio.to_thread(generate_discount_codes, count, prefix)
+    stored = await store_discount_codes([(code, value, max_uses, expires_at) for code in codes], replace=False)
+    document = await asyncio.to_thread(codes_csv, stored, value, max_uses, expires_at) # فقط کدهای ذخیره‌شده
+    await update.message.reply_document(
+        document=document,
+        filename=f"discount_codes_{int(time.time())}.csv",
+        caption=f"✅ {len(stored)} کد {value} تومانی ساخته شد."
+    )
+    return ConversationHandler.END
+
+# مرحله اول شارژ کاربر (توسط ادمین - حالا از CallbackQuery)
+async def ask_charge(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text("ID کاربر و مبلغ (مثال: 123456789 10000):", reply_markup=ReplyKeyboardRemove())
+    return 10 # حالت برای انتظار پاسخ ادمین
+
+# مرحله دوم شارژ کاربر: انجام شارژ
+async def do_charge(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        uid, amount = update.message.text.strip().split()
+        await charge_credit(int(uid), int(amount), update.effective_user.id)
+        if int(amount) > 0:
+            await close_user_requests(int(uid), "topup", update.effective_user.id)
+        await update.message.reply_text("✅ شارژ شد.", reply_markup=ReplyKeyboardRemove())
+    except UnknownUser:
+        await update.message.reply_text("❌ کاربر پیدا نشد.", reply_markup=ReplyKeyboardRemove())
+    except InsufficientCredit:
+        await update.message.reply_text("❌ اعتبار کاربر برای این کسر کافی نیست.", reply_markup=ReplyKeyboardRemove())
+    except:
+        await update.message.reply_text("❌ خطا در ورودی.", reply_markup=ReplyKeyboardRemove())
+    return ConversationHandler.END # پایان مکالمه
+
+# **ورود و خروج گروهی (CSV)**
+# خروجی کاربران و ledger با یک cursor جریانی در یک فایل موقت نوشته می‌شود (حافظه ثابت، هر اندازه جدول) و به صورت
+# سند برای ادمین ارسال می‌شود. ورود CSV شارژها/تأییدها را در یک تراکنش اعمال می‌کند: یا همه ردیف‌ها یا هیچ‌کدام.
+BULK_USERS = 19 # حالت مکالمه ادمین
+USERS_EXPORT_COLUMNS = ("id", "username", "credit", "discount_used", "is_approved", "is_blocked")
+LEDGER_EXPORT_COLUMNS = ("id", "user_id", "delta", "kind", "ref", "created_at", "created_at_local")
+
+
+class ImportRowError(Exception):
+    def __init__(self, line, reason):
+        super().__init__(line, reason)
+        self.line = line
+        self.reason = reason
+
+
+async def _send_export(message, name, header, sql, params=()):
+    with tempfile.TemporaryFile() as raw:
+        text = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="") # BOM برای نمایش درست نام‌های فارسی در Excel
+        count = await db.export_csv(text, header, sql, params)
+        text.flush()
+        text.detach()
+        raw.seek(0)
+        await message.reply_document(
+            document=raw,
+            filename=f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.csv",
+            caption=f"📄 {count} ردیف"
+        )
+
+
+# /export_users - خروجی همه کاربران
+async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return
+    await _send_export(
+        update.message, "users", USERS_EXPORT_COLUMNS,
+        f"SELECT {', '.join(USERS_EXPORT_COLUMNS)} FROM users ORDER BY id"
+    )
+
+
+# /export_ledger [از YYYY-MM-DD] [تا YYYY-MM-DD] - خروجی حرکات اعتبار (با ایندکس idx_ledger_time)
+async def export_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return
+    try:
+        bounds = [int(time.mktime(time.strptime(arg, "%Y-%m-%d"))) for arg in context.args[:2]]
+    except ValueError:
+        await update.message.reply_text("❌ فرمت تاریخ: /export_ledger 2025-06-01 2025-07-01")
+        return
+    start = bounds[0] if bounds else 0
+    end = bounds[1] if len(bounds) > 1 else 2 ** 62
+    await _send_export(
+        update.message, "ledger", LEDGER_EXPORT_COLUMNS,
+        "SELECT id, user_id, delta, kind, ref, created_at, datetime(created_at, 'unixepoch', 'localtime') "
+        "FROM ledger WHERE created_at >= ? AND created_at < ? ORDER BY created_at, id",
+        (start, end)
+    )
+
+
+def parse_users_csv(data):
+    # ستون‌ها: user_id,amount[,approve] - amount می‌تواند 0 یا منفی (کسر) باشد؛ approve برابر 1 یعنی تأیید کاربر
+    rows = []
+    for line_number, row in enumerate(csv.reader(io.StringIO(data.decode("utf-8-sig"))), start=1):
+        row = [cell.strip() for cell in row]
+        if not row or not row[0]:
+            continue
+        if line_number == 1 and not row[0].isdigit():
+            continue # سطر عنوان
+        try:
+            uid, amount, approve = (row + ["", ""])[:3]
+            if len(row) > 3 or approve not in ("", "0", "1"):
+                raise ValueError(row)
+            rows.append((line_number, int(uid), int(amount or 0), approve == "1"))
+        except ValueError:
+            raise ValueError(line_number)
+    return rows
+
+
+def _apply_user_rows(conn, rows, ref):
+    charged, approved = 0, []
+    for line_number, uid, amount, approve in rows:
+        try:
+            if amount:
+                post_credit(conn, uid, amount, "charge", ref)
+                charged += amount
+            if approve:
+                if conn.execute("UPDATE users SET is_approved = 1 WHERE id=? AND is_approved = 0", (uid,)).rowcount:
+                    approved.append(uid)
+                elif not conn.execute("SELECT 1 FROM users WHERE id=?", (uid,)).fetchone():
+                    raise UnknownUser(uid)
+        except LedgerError as e:
+            raise ImportRowError(line_number, e)
+    return charged, approved
+
+
+async def _notify_approved(bot, uids):
+    limiter = RateLimiter(BROADCAST_RATE)
+    for uid in uids:
+        await _broadcast_send(bot, limiter, uid, "اکانت شما توسط ادمین تأیید شد. اکنون می‌توانید از خدمات استفاده کنید.")
+
+
+# /import_users - مرحله اول: درخواست فایل CSV
+async def ask_users_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return ConversationHandler.END
+    await update.message.reply_text(
+        "📤 فایل CSV با ستون‌های user_id,amount,approve را ارسال کنید:\n"
+        "• amount: مبلغ شارژ (منفی برای کسر، 0 یا خالی برای بدون شارژ)\n"
+        "• approve: 1 برای تأیید کاربر (اختیاری)\n"
+        "همه ردیف‌ها در یک تراکنش اعمال می‌شوند؛ با خطا در هر ردیف هیچ تغییری ذخیره نمی‌شود."
+    )
+    return BULK_USERS
+
+# مرحله دوم: اعمال فایل در یک تراکنش
+async def import_users_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = await (await update.message.document.get_file()).download_as_bytearray()
+    try:
+        rows = await asyncio.to_thread(parse_users_csv, bytes(data)) # فایل‌های بزرگ event loop را متوقف نمی‌کنند
+    except (ValueError, UnicodeDecodeError) as e:
+        line = f" (سطر {e.args[0]})" if isinstance(e, ValueError) and e.args else ""
+        await update.message.reply_text(f"❌ فایل CSV نامعتبر است{line}. هیچ تغییری اعمال نشد.")
+        return ConversationHandler.END
+    if not rows:
+        await update.message.reply_text("❌ فایل هیچ ردیفی ندارد.")
+        return ConversationHandler.END
+
+    ref = f"import:{update.message.document.file_name or update.message.document.file_unique_id}"
+
+    def apply(conn):
+        return _apply_user_rows(conn, rows, ref)
+
+    try:
+        charged, approved = await db.transaction(apply)
+    except ImportRowError as e:
+        reason = "کاربر پیدا نشد" if isinstance(e.reason, UnknownUser) else "اعتبار کاربر برای کسر کافی نیست"
+        await update.message.reply_text(f"❌ سطر {e.line}: {reason}. هیچ تغییری اعمال نشد.")
+        return ConversationHandler.END
+    user_cache.clear()
+    if approved:
+        start_background(_notify_approved(context.bot, approved))
+    await update.message.reply_text(
+        f"✅ {len(rows)} ردیف اعمال شد.\n💰 مجموع شارژ: {charged} تومان\n🧾 کاربران تأییدشده: {len(approved)}"
+    )
+    return ConversationHandler.END
+
+# مرحله اول پیام همگانی (توسط ادمین - حالا از CallbackQuery)
+async def ask_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await query.message.reply_text("پیام همگانی را ارسال کنید:", reply_markup=ReplyKeyboardRemove())
+    return 11 # حالت برای انتظار پاسخ ادمین
+
+# مرحله دوم پیام همگانی: ساخت job و ارسال در پس‌زمینه
+async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message.text
+    progress = await update.message.reply_text("📢 ارسال همگانی شروع شد...", reply_markup=ReplyKeyboardRemove())
+    now = int(time.time())
+
+    def create_job(conn):
+        cur = conn.execute(
+            "INSERT INTO broadcast_jobs (text, admin_chat_id, progress_message_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (msg, progress.chat_id, progress.message_id, now, now)
+        )
+        return cur.lastrowid
+
+    job_id = await db.transaction(create_job)
+    start_background(run_broadcast_job(context.bot, job_id))
+    return ConversationHandler.END # پایان مکالمه (ادمین منتظر پایان ارسال نمی‌ماند)
+
+
+# **موتور ارسال همگانی**
+# گیرنده‌ها دسته به دسته (keyset روی id) از دیتابیس خوانده می‌شوند، با همزمانی محدود و زیر سقف نرخ
+# سراسری تلگرام ارسال می‌شوند و پیشرفت بعد از هر دسته در broadcast_jobs ذخیره می‌شود.
+# چون هر کاربر فقط یک پیام می‌گیرد، محدودیت نرخ per-chat خودبه‌خود رعایت می‌شود.
+# پس از کرش، حداکثر یک دسته ممکن است دوباره ارسال شود.
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # پیام در ثانیه (سقف تلگرام حدود 30 است)
+BROADCAST_PROGRESS_INTERVAL = 5  # ثانیه بین به‌روزرسانی‌های پیام پیشرفت
+BROADCAST_MAX_ATTEMPTS = 3
+
+_background_tasks = set()
+
+
+def start_background(coro):
+    # نگه داشتن ارجاع به task تا garbage collector آن را وسط کار از بین نبرد
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# محدودکننده نرخ سراسری (token bucket) که با RetryAfter کل ارسال را متوقف می‌کند
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+async def _broadcast_send(bot, limiter, uid, text, reply_markup=None):
+    for _ in range(BROADCAST_MAX_ATTEMPTS):
+        await limiter.acquire()
+        try:
+            await bot.send_message(chat_id=uid, text=text, reply_markup=reply_markup)
+            return "sent"
+        except RetryAfter as e:
+            limiter.pause(e.retry_after)
+        except Forbidden: # کاربر ربات را بلاک کرده یا حسابش حذف شده
+            return "blocked"
+        except (TimedOut, NetworkError):
+            await asyncio.sleep(1)
+        except TelegramError:
+            return "failed"
+    return "failed"
+
+
+def _broadcast_progress_text(sent, failed, blocked, rate, done):
+    header = "✅ ارسال همگانی تمام شد." if done else "📢 ارسال همگانی در حال انجام است..."
+    return (
+        f"{header}\n"
+        f"ارسال شده: {sent}\n"
+        f"ناموفق: {failed}\n"
+        f"بلاک کرده‌اند: {blocked}\n"
+        f"سرعت: {rate:.1f} پیام در ثانیه"
+    )
+
+
+async def run_broadcast_job(bot, job_id):
+    row = await db.fetchone(
+        "SELECT text, last_user_id, sent, failed, blocked, admin_chat_id, progress_message_id FROM broadcast_jobs WHERE id=?",
+        (job_id,)
+    )
+    text, last_id, sent, failed, blocked, admin_chat_id, progress_message_id = row
+    limiter = RateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started, sent_at_start = time.monotonic(), sent
+    last_report = started
+
+    async def report(done=False):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        progress_text = _broadcast_progress_text(sent, failed, blocked, (sent - sent_at_start) / elapsed, done)
+        try:
+            await bot.edit_message_text(progress_text, chat_id=admin_chat_id, message_id=progress_message_id)
+        except TelegramError:
+            pass # مثلا پیام تغییری نکرده یا حذف شده
+
+    async def deliver(uid):
+        async with semaphore:
+            return uid, await _broadcast_send(bot, limiter, uid, text)
+
+    while True:
+        recipients = await db.fetchall(
+            "SELECT id FROM users WHERE id > ? AND is_blocked = 0 ORDER BY id LIMIT ?",
+            (last_id, BROADCAST_CHUNK_SIZE)
+        )
+        if not recipients:
+            break
+        results = await asyncio.gather(*(deliver(uid) for (uid,) in recipients))
+        blocked_ids = [(uid,) for uid, outcome in results if outcome == "blocked"]
+        chunk_sent = sum(1 for _, outcome in results if outcome == "sent")
+        chunk_failed = sum(1 for _, outcome in results if outcome == "failed")
+        last_id = recipients[-1][0]
+
+        def save_progress(conn):
+            if blocked_ids:
+                conn.executemany("UPDATE users SET is_blocked = 1 WHERE id=?", blocked_ids)
+            conn.execute(
+                "UPDATE broadcast_jobs SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+?, updated_at=? WHERE id=?",
+                (last_id, chunk_sent, chunk_failed, len(blocked_ids), int(time.time()), job_id)
+            )
+
+        await db.transaction(save_progress)
+        sent, failed, blocked = sent + chunk_sent, failed + chunk_failed, blocked + len(blocked_ids)
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await report()
+
+    await db.execute("UPDATE broadcast_jobs SET status='done', updated_at=? WHERE id=?", (int(time.time()), job_id))
+    await report(done=True)
+
+
+# بستن دیتابیس هنگام خاموش شدن ربات (نوشتن‌های در صف قبل از خروج commit می‌شوند)
+async def close_database(application: Application):
+    await asyncio.to_thread(db.close)
+
+
+# ادامه ارسال‌های همگانی نیمه‌تمام پس از ری‌استارت ربات
+async def resume_broadcasts(application: Application):
+    for (job_id,) in await db.fetchall("SELECT id FROM broadcast_jobs WHERE status='running'"):
+        start_background(run_broadcast_job(application.bot, job_id))
+
+
+# **اعلان‌های ادمین (خلاصه‌سازی)**
+# درخواست‌های خرید/سرویس/افزایش اعتبار به جای یک پیام جدا برای هر کدام، در یک پنجره زمانی جمع می‌شوند و در یک پیام
+# خلاصه (با دکمه جداگانه برای هر درخواست) برای ادمین ارسال می‌شوند؛ انواع فوری همان لحظه ارسال می‌شوند.
+# انواع اعلان: purchase, service, topup, sale, stock, expiry (پیام‌های پشتیبانی relay می‌شوند و از اینجا نمی‌گذرند)
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", "30")) # ثانیه؛ 0 = ارسال فوری همه اعلان‌ها
+ADMIN_URGENT_KINDS = frozenset(filter(None, os.getenv("ADMIN_URGENT_KINDS", "stock").split(","))) # هشدار کمبود موجودی فوری است
+ADMIN_DIGEST_MAX_ITEMS = 20 # حداکثر درخواست (و دکمه) در هر پیام خلاصه
+ADMIN_DIGEST_TEXT_LIMIT = 2400 # کمتر از سقف 4096 کاراکتری پیام تلگرام، با جا برای یادداشت‌هایی که start_send_item اضافه می‌کند
+
+
+class AdminNotifier:
+    def __init__(self, window=ADMIN_DIGEST_WINDOW, urgent_kinds=ADMIN_URGENT_KINDS):
+        self.window = window
+        self.urgent_kinds = urgent_kinds
+        self._pending = [] # (text, button)
+        self._flush_task = None
+
+    async def notify(self, bot, kind, text, button=None):
+        if self.window <= 0 or kind in self.urgent_kinds:
+            metrics.inc("bot_admin_notifications_total", kind=kind, mode="immediate")
+            await self._send(bot, text, InlineKeyboardMarkup([[button]]) if button else None)
+            return
+        metrics.inc("bot_admin_notifications_total", kind=kind, mode="digest")
+        self._pending.append((text, button))
+        if self._flush_task is None:
+            self._flush_task = start_background(self._flush_later(bot))
+
+    async def _flush_later(self, bot):
+        await asyncio.sleep(self.window)
+        await self.flush(bot)
+
+    async def flush(self, bot):
+        task, self._flush_task = self._flush_task, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        pending, self._pending = self._pending, []
+        for text, reply_markup in self._digests(pending):
+            try:
+                await self._send(bot, text, reply_markup)
+            except TelegramError as e:
+                print(f"Admin digest failed: {e}")
+
+    def _digests(self, pending):
+        if len(pending) == 1: # یک درخواست تنها همان شکل پیام معمولی را دارد
+            text, button = pending[0]
+            yield text, InlineKeyboardMarkup([[button]]) if button else None
+            return
+        chunk, length = [], 0
+        for item in pending:
+            if chunk and (len(chunk) == ADMIN_DIGEST_MAX_ITEMS or length + len(item[0]) > ADMIN_DIGEST_TEXT_LIMIT):
+                yield self._render(chunk)
+                chunk, length = [], 0
+            chunk.append(item)
+            length += len(item[0]) + 8
+        if chunk:
+            yield self._render(chunk)
+
+    @staticmethod
+    def _render(chunk):
+        lines = [f"📬 خلاصه {len(chunk)} درخواست جدید:"]
+        keyboard = []
+        for number, (text, button) in enumerate(chunk, start=1):
+            lines.append(f"\n{number}) {text}")
+            if button:
+                keyboard.append([InlineKeyboardButton(f"{number}. {button.text}", callback_data=button.callback_data)])
+        return "\n".join(lines), InlineKeyboardMarkup(keyboard) if keyboard else None
+
+    @staticmethod
+    async def _send(bot, text, reply_markup=None):
+        # خطای موقت شبکه کل خلاصه را از بین نمی‌برد: تلاش دوباره با فاصله 1، 2، ... ثانیه
+        for attempt in range(BROADCAST_MAX_ATTEMPTS):
+            try:
+                return await bot.send_message(chat_id=ADMIN_ID, text=text, reply_markup=reply_markup)
+            except RetryAfter as e:
+                if attempt == BROADCAST_MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(e.retry_after)
+            except NetworkError: # شامل TimedOut
+                if attempt == BROADCAST_MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+
+
+admin_notifier = AdminNotifier()
 
-# مرحله اول پیام همگانی (توسط ادمین - حالا از CallbackQuery)
-async def ask_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await query.message.reply_text("پیام همگانی را ارسال کنید:", reply_markup=ReplyKeyboardRemove())
-    return 11 # حالت برای انتظار پاسخ ادمین
 
-# مرحله دوم پیام همگانی: ارسال پیام به همه کاربران
-async def send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = update.message.text
-    cursor.execute("SELECT id FROM users")
-    for (uid,) in cursor.fetchall():
-        try:
-            await context.bot.send_message(chat_id=uid, text=msg)
-        except Exception as e: # برای مدیریت خطاهای احتمالی (مثل بلاک کردن ربات)
-            print(f"Error sending broadcast to {uid}: {e}")
-            continue
-    await update.message.reply_text("📢 پیام ارسال شد.", reply_markup=ReplyKeyboardRemove())
-    return ConversationHandler.END # پایان مکالمه
+# ارسال اعلان‌های باقی‌مانده در بافر هنگام توقف ربات
+async def flush_admin_notifications(application: Application):
+    await admin_notifier.flush(application.bot)
+
 
 # مرحله اول پیام به پشتیبانی
 async def message_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -568,13 +2881,77 @@ async def message_to_support(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.message.reply_text("لطفاً پیام خود را برای پشتیبانی ارسال کنید:", reply_markup=ReplyKeyboardRemove())
     return 12 # حالت برای انتظار پاسخ کاربر
 
-# مرحله دوم پیام به پشتیبانی: ارسال پیام به ادمین
+# **relay پیام‌ها بین ادمین و کاربر (بدون دانلود/آپلود دوباره)**
+# هر نوع پیامی (متن، عکس، فایل .ovpn، ویس و ...) با copy_message و همان file_id تلگرام منتقل می‌شود.
+# برای هر پیام کپی‌شده یک ردیف در جدول relay ثبت می‌شود؛ اگر ادمین (یا کاربر) روی آن reply کند،
+# پاسخ به طرف مقابل و به صورت reply روی پیام اصلی می‌رسد.
+RELAY_RETENTION_DAYS = 30 # نگاشت‌های قدیمی‌تر پاک می‌شوند
+CAPTION_LIMIT = 1024 # محدودیت طول caption در تلگرام
+
+
+async def relay_message(bot, message, chat_id, prefix="", reply_to_message_id=None):
+    # کپی پیام به chat_id و ثبت نگاشت پیام(های) ساخته‌شده به پیام مبدأ
+    sent_ids = []
+    if message.text:
+        sent = await bot.send_message(chat_id=chat_id, text=prefix + message.text, reply_to_message_id=reply_to_message_id)
+        sent_ids.append(sent.message_id)
+    else:
+        caption = None
+        if prefix:
+            captionable = message.photo or message.video or message.document or message.audio or message.voice or message.animation
+            if captionable and len(prefix) + len(message.caption or "") <= CAPTION_LIMIT:
+                caption = (prefix + (message.caption or "")).rstrip()
+            else: # استیکر، موقعیت و ... caption ندارند: توضیح جدا ارسال می‌شود
+                sent = await bot.send_message(chat_id=chat_id, text=prefix.rstrip(), reply_to_message_id=reply_to_message_id)
+                sent_ids.append(sent.message_id)
+        copied = await bot.copy_message(
+            chat_id=chat_id, from_chat_id=message.chat_id, message_id=message.message_id,
+            caption=caption, reply_to_message_id=reply_to_message_id
+        )
+        sent_ids.append(copied.message_id)
+    now = int(time.time())
+    await db.executemany(
+        "INSERT OR REPLACE INTO relay (chat_id, message_id, peer_chat_id, peer_message_id, created_at) VALUES (?, ?, ?, ?, ?)",
+        [(chat_id, sent_id, message.chat_id, message.message_id, now) for sent_id in sent_ids]
+    )
+    metrics.inc("bot_relayed_messages_total", direction="to_admin" if chat_id == ADMIN_ID else "to_user")
+
+
+# reply روی یک پیام relayشده (خارج از مکالمه‌ها): پاسخ ادمین به کاربر یا پاسخ کاربر به ادمین
+async def relay_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    row = await db.fetchone(
+        "SELECT peer_chat_id, peer_message_id FROM relay WHERE chat_id=? AND message_id=?",
+        (message.chat_id, message.reply_to_message.message_id)
+    )
+    if row is None:
+        return
+    peer_chat_id, peer_message_id = row
+    user = update.effective_user
+    if user.id == ADMIN_ID:
+        prefix = "پیام از ادمین: "
+    elif peer_chat_id == ADMIN_ID:
+        prefix = f"↩️ پاسخ @{user.username} (ID: {user.id}): "
+    else:
+        return
+    try:
+        await relay_message(context.bot, message, peer_chat_id, prefix, reply_to_message_id=peer_message_id)
+        await message.reply_text("✅ پاسخ شما ارسال شد.")
+    except TelegramError as e:
+        await message.reply_text(f"❌ خطا در ارسال پاسخ: {e}")
+
+
+async def prune_relay(context: ContextTypes.DEFAULT_TYPE):
+    await db.execute("DELETE FROM relay WHERE created_at < ?", (int(time.time()) - RELAY_RETENTION_DAYS * 86400,))
+
+
+# مرحله دوم پیام به پشتیبانی: ارسال پیام (از هر نوع) به ادمین
 async def send_support_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    support_message = update.message.text
-    msg_for_admin = f"✉️ پیام جدید از پشتیبانی:\nکاربر: @{user.username} (ID: {user.id})\nپیام: {support_message}"
+    prefix = f"✉️ پیام جدید از پشتیبانی:\nکاربر: @{user.username} (ID: {user.id})\n(برای پاسخ، روی این پیام reply کنید)\nپیام: "
 
-    await context.bot.send_message(chat_id=ADMIN_ID, text=msg_for_admin)
+    metrics.inc("bot_admin_notifications_total", kind="support", mode="relay")
+    await relay_message(context.bot, update.message, ADMIN_ID, prefix)
     await update.message.reply_text("✅ پیام شما به پشتیبانی ارسال شد. لطفاً منتظر پاسخ باشید.", reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END # پایان مکالمه
 
@@ -583,15 +2960,25 @@ SENDING_ITEM_DETAILS = 13 # ثابت برای حالت مکالمه ادمین (
 
 async def start_send_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
+    args = parse_callback(query.data)[1]
+    request_id = None
+    if len(args) == 1:
+        # callback_data format: "send_item:<request_id>"; the request row holds the user, item type and product
+        request_id = int(args[0])
+        row = await db.fetchone("SELECT user_id, kind, product, status FROM requests WHERE id=?", (request_id,))
+        if row is None or row[3] != "open":
+            await query.answer("این درخواست قبلاً انجام یا لغو شده است.", show_alert=True)
+            return ConversationHandler.END
+        target_user_id, item_type, product = row[:3]
+        item_name = product.replace("_", " ")
+    else:
+        # Buttons sent before the requests table: "send_item:<user_id>:<item_type>:<item_name>"
+        user_id_arg, item_type, item_name = args
+        target_user_id = int(user_id_arg)
+    # item_type e.g., 'account', 'service' / item_name e.g., '1 month', 'OpenVPN', 'Proxy Telegram'
     await query.answer()
 
-    # Extract user ID, item type, and item name from callback_data
-    # callback_data format: "send_item_to_<user_id>_<item_type>_<item_name>"
-    parts = query.data.split('_')
-    target_user_id = int(parts[3])
-    item_type = parts[4] # e.g., 'account', 'service'
-    item_name = " ".join(parts[5:]) # e.g., '1 month', 'OpenVPN', 'Proxy Telegram'
-
+    context.user_data['request_id'] = request_id
     context.user_data['target_user_id_for_item'] = target_user_id
     context.user_data['item_type'] = item_type
     context.user_data['item_name'] = item_name
@@ -601,10 +2988,17 @@ async def start_send_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=ReplyKeyboardRemove() # Remove keyboard if any
     )
     # Edit the inline button message to show it's being processed
-    # Also remove the button to prevent multiple clicks
-    await query.edit_message_reply_markup(reply_markup=None)
+    # Also remove the clicked button to prevent multiple clicks (other requests of a digest keep their buttons)
+    remaining = [
+        [button for button in row if button.callback_data != query.data]
+        for row in query.message.reply_markup.inline_keyboard
+    ] if query.message.reply_markup else []
+    remaining = [row for row in remaining if row]
     # Append a confirmation to the original message for admin's clarity
-    await query.message.edit_text(query.message.text + f"\n\n✅ شما در حال آماده‌سازی {item_type} برای کاربر هستید.")
+    await query.message.edit_text(
+        query.message.text + f"\n\n✅ شما در حال آماده‌سازی {item_type} برای کاربر ID: {target_user_id} هستید.",
+        reply_markup=InlineKeyboardMarkup(remaining) if remaining else None
+    )
 
     return SENDING_ITEM_DETAILS # Go to the next state to receive item details
 
@@ -612,21 +3006,24 @@ async def send_item_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_user_id = context.user_data.get('target_user_id_for_item')
     item_type = context.user_data.get('item_type')
     item_name = context.user_data.get('item_name')
-    item_details_from_admin = update.message.text # Admin's message containing item details
 
     if not target_user_id:
+        await release_held_claim(context)
         await update.message.reply_text("خطا: شناسه کاربر مقصد یافت نشد. لطفاً دوباره تلاش کنید.")
         return ConversationHandler.END
 
     try:
-        # Send item details to the user
-        await context.bot.send_message(
-            chat_id=target_user_id,
-            text=f"✨ {item_type} {item_name} شما آماده شد!:\n\n{item_details_from_admin}\n\n"
-                  "با آرزوی استفاده عالی از سرویس ما!"
-        )
+        # Send item details to the user (config files, screenshots, ... are relayed without re-uploading)
+        if update.message.text:
+            await deliver_item(context.bot, target_user_id, item_type, item_name, update.message.text)
+        else:
+            await relay_message(context.bot, update.message, target_user_id, deliver_item_prefix(item_type, item_name))
         # Inform admin
         await update.message.reply_text(f"✅ مشخصات {item_type} با موفقیت به کاربر ID: {target_user_id} ارسال شد.", reply_markup=ReplyKeyboardRemove())
+        finish_held_claim(context)
+        request_id = context.user_data.pop('request_id', None)
+        if request_id is not None and await close_request(request_id, "done", update.effective_user.id):
+            await start_subscription(request_id)
 
         # Clear user_data for next interaction
         if 'target_user_id_for_item' in context.user_data:
@@ -637,10 +3034,164 @@ async def send_item_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             del context.user_data['item_name']
 
     except Exception as e:
+        await release_held_claim(context) # ارسال انجام نشد؛ دکمه دوباره قابل استفاده است
         await update.message.reply_text(f"❌ خطا در ارسال {item_type} به کاربر ID: {target_user_id}: {e}", reply_markup=ReplyKeyboardRemove())
 
     return ConversationHandler.END # End the conversation
 
+def deliver_item_prefix(item_type, item_name):
+    return f"✨ {item_type} {item_name} شما آماده شد!:\n\n"
+
+
+async def deliver_item(bot, user_id, item_type, item_name, details):
+    await bot.send_message(
+        chat_id=user_id,
+        text=deliver_item_prefix(item_type, item_name) + f"{details}\n\n"
+              "با آرزوی استفاده عالی از سرویس ما!"
+    )
+
+
+# **موجودی آماده (تحویل خودکار)**
+# ادمین اکانت‌ها/کانفیگ‌های آماده هر محصول را یکجا بارگذاری می‌کند؛ خرید یک آیتم را به صورت اتمیک برمی‌دارد و
+# همان لحظه تحویل می‌دهد. اگر موجودی تمام شده باشد، درخواست مثل قبل برای ادمین ارسال می‌شود.
+STOCK_PRODUCTS = { # کلید محصول (همان آرگومان buy_type/service_type) -> نوع آیتم
+    "1_month": "account",
+    "3_month": "account",
+    "special": "account",
+    "access_point": "account",
+    "OpenVPN": "service",
+    "V2Ray": "service",
+    "Proxy_Telegram": "service",
+}
+STOCK_LOW_THRESHOLD = int(os.getenv("STOCK_LOW_THRESHOLD", "5"))
+STOCK_PRODUCT = 17 # حالت‌های مکالمه ادمین
+STOCK_ITEMS = 18
+
+
+def _claim_stock(conn, user_id, product, request_id):
+    row = conn.execute(
+        "SELECT id, content FROM stock WHERE product=? AND claimed_by IS NULL ORDER BY id LIMIT 1", (product,)
+    ).fetchone()
+    if row is None:
+        return None
+    # سفارش در همین تراکنش بسته می‌شود؛ سفارشی که قبلا انجام/لغو شده آیتمی برنمی‌دارد
+    if not _close_request(conn, request_id, "done"):
+        return None
+    conn.execute("UPDATE stock SET claimed_by=?, claimed_at=? WHERE id=?", (user_id, int(time.time()), row[0]))
+    remaining = conn.execute("SELECT COUNT(*) FROM stock WHERE product=? AND claimed_by IS NULL", (product,)).fetchone()[0]
+    return row[0], row[1], remaining
+
+
+def _release_stock(conn, item_id, request_id):
+    conn.execute("UPDATE stock SET claimed_by=NULL, claimed_at=NULL WHERE id=?", (item_id,))
+    conn.execute("UPDATE requests SET status='cancelled', updated_at=? WHERE id=?", (int(time.time()), request_id))
+
+
+async def fulfil_from_stock(bot, user_id, username, product, request_id):
+    # True اگر آیتم از موجودی تحویل داده شد (و سفارش بسته شد)؛ False یعنی باید مسیر دستی (ادمین) طی شود
+    item_type = STOCK_PRODUCTS.get(product)
+    if item_type is None:
+        return False
+    def claim(conn):
+        return _claim_stock(conn, user_id, product, request_id)
+
+    claimed = await db.transaction(claim)
+    if claimed is None:
+        metrics.inc("bot_stock_claims_total", product=product, result="empty")
+        return False
+    item_id, content, remaining = claimed
+    item_name = product.replace("_", " ")
+    try:
+        await deliver_item(bot, user_id, item_type, item_name, content)
+    except TelegramError:
+        # تحویل ناموفق: آیتم به موجودی برمی‌گردد و سفارش لغو می‌شود تا کاربر بتواند دوباره سفارش دهد
+        def release(conn):
+            _release_stock(conn, item_id, request_id)
+        await db.transaction(release)
+        metrics.inc("bot_stock_claims_total", product=product, result="failed")
+        raise
+    metrics.inc("bot_stock_claims_total", product=product, result="delivered")
+    await start_subscription(request_id)
+    await admin_notifier.notify(bot, "sale", f"🤖 {item_type} {item_name} به صورت خودکار به @{username} (ID: {user_id}) تحویل شد (#{request_id}).")
+    if remaining in (STOCK_LOW_THRESHOLD, 0):
+        await admin_notifier.notify(bot, "stock", f"⚠️ موجودی {item_name}: {remaining} آیتم باقی مانده است.")
+    return True
+
+
+async def stock_counts():
+    rows = await db.fetchall("SELECT product, COUNT(*) FROM stock WHERE claimed_by IS NULL GROUP BY product")
+    return dict(rows)
+
+
+def parse_stock_items(text):
+    # اگر متن خط خالی داشته باشد هر بلوک یک آیتم است (اکانت چندخطی)، وگرنه هر خط یک آیتم (لینک کانفیگ)
+    text = text.replace("\r\n", "\n").strip()
+    items = text.split("\n\n") if "\n\n" in text else text.split("\n")
+    return [item.strip() for item in items if item.strip()]
+
+
+# مرحله اول بارگذاری موجودی (توسط ادمین): انتخاب محصول
+async def ask_stock_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if update.effective_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return ConversationHandler.END
+    counts = await stock_counts()
+    keyboard = [
+        [InlineKeyboardButton(f"{product.replace('_', ' ')} ({counts.get(product, 0)})", callback_data=encode_callback("stock_product", product))]
+        for product in STOCK_PRODUCTS
+    ]
+    await query.message.reply_text("📥 موجودی کدام محصول را بارگذاری می‌کنید؟ (عدد داخل پرانتز = موجودی فعلی)", reply_markup=InlineKeyboardMarkup(keyboard))
+    return STOCK_PRODUCT
+
+# مرحله دوم: دریافت آیتم‌ها
+async def ask_stock_items(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    product = parse_callback(query.data)[1][0]
+    if product not in STOCK_PRODUCTS:
+        return ConversationHandler.END
+    context.user_data["stock_product"] = product
+    await query.message.reply_text(
+        f"آیتم‌های {product.replace('_', ' ')} را به صورت متن یا فایل txt ارسال کنید:\n"
+        "• هر خط یک آیتم (مثلا لینک کانفیگ)\n"
+        "• یا برای آیتم‌های چندخطی، بین آیتم‌ها یک خط خالی بگذارید"
+    )
+    return STOCK_ITEMS
+
+# مرحله سوم: ذخیره همه آیتم‌ها در یک تراکنش
+async def save_stock_items(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    product = context.user_data.pop("stock_product", None)
+    if product is None:
+        return ConversationHandler.END
+    if update.message.document:
+        data = await (await update.message.document.get_file()).download_as_bytearray()
+        text = bytes(data).decode("utf-8-sig", errors="replace")
+    else:
+        text = update.message.text
+    items = parse_stock_items(text)
+    if not items:
+        await update.message.reply_text("❌ هیچ آیتمی پیدا نشد.")
+        return ConversationHandler.END
+
+    def store(conn):
+        before = conn.total_changes
+        now = int(time.time())
+        conn.executemany(
+            "INSERT OR IGNORE INTO stock (product, content, created_at) VALUES (?, ?, ?)",
+            [(product, item, now) for item in items]
+        )
+        return conn.total_changes - before
+
+    stored = await db.transaction(store)
+    available = (await stock_counts()).get(product, 0)
+    await update.message.reply_text(
+        f"✅ {stored} آیتم به موجودی {product.replace('_', ' ')} اضافه شد"
+        + (f" ({len(items) - stored} آیتم تکراری نادیده گرفته شد)" if stored < len(items) else "")
+        + f".\n📦 موجودی فعلی: {available}"
+    )
+    return ConversationHandler.END
+
 # **جدید: توابع و ثابت‌ها برای قابلیت چت ادمین با کاربر**
 ADMIN_CHAT_TARGET_USER = 14
 ADMIN_CHATTING = 15
@@ -671,7 +3222,7 @@ async def admin_send_message_to_user(update: Update, context: ContextTypes.DEFAU
         return ConversationHandler.END
 
     try:
-        await context.bot.send_message(chat_id=target_user_id, text=f"پیام از ادمین: {update.message.text}")
+        await relay_message(context.bot, update.message, target_user_id, "پیام از ادمین: ")
         await update.message.reply_text("✅ پیام شما ارسال شد.")
     except Exception as e:
         await update.message.reply_text(f"❌ خطا در ارسال پیام به کاربر: {e}")
@@ -685,168 +3236,973 @@ async def exit_admin_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-# تابع اصلی
-def main():
-    application = Application.builder().token(TOKEN).build()
+# **ابزارگذاری handlerها، Bot API و endpoint سنجه‌ها**
+# درخواست‌های HTTP به Bot API از این کلاس عبور می‌کنند تا تأخیر و خطای هر متد ثبت شود
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data=request_data, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_request_seconds", time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            metrics.inc("bot_api_errors_total", method=api_method, error=str(code))
+        return code, payload
+
+
+def timed_handler(callback, action=None):
+    labels = {"handler": callback.__name__}
+    if action is not None:
+        labels["action"] = action # مسیرهای callback_router
+
+    @wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise # توقف عمدی پردازش (flood_guard)، خطا نیست
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", error=type(e).__name__, **labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, **labels)
+    return timed
+
+
+def instrument_handlers(application):
+    # callback تمام handlerها (از جمله داخل ConversationHandlerها و مسیرهای router) با timed_handler پوشانده می‌شود
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for h in handler.entry_points + handler.fallbacks:
+                wrap(h)
+            for state_handlers in handler.states.values():
+                for h in state_handlers:
+                    wrap(h)
+        elif isinstance(handler, ConversationRouter):
+            for conversation in handler.conversations:
+                wrap(conversation)
+        elif isinstance(getattr(handler.callback, "__self__", None), CallbackRouter):
+            handler.callback.__self__.wrap_routes(timed_handler)
+        else:
+            handler.callback = timed_handler(handler.callback)
+
+    for group_handlers in application.handlers.values():
+        for handler in group_handlers:
+            wrap(handler)
+
+
+def conversation_state_counts(application):
+    # تعداد مکالمه‌های فعال در هر وضعیت هر ConversationHandler
+    counts = defaultdict(int)
+    for handler in iter_conversations(application):
+        for state in handler._conversations.values():
+            counts[(handler.name, str(state))] += 1
+    return [({"conversation": name, "state": state}, n) for (name, state), n in sorted(counts.items())]
+
+
+def register_gauges(application):
+    metrics.gauge("bot_conversations", lambda: conversation_state_counts(application))
+    metrics.gauge("bot_db_write_queue_depth", lambda: [({}, db.queue_depth())])
+    metrics.gauge("bot_user_cache_hits", lambda: [({}, user_cache.hits)])
+    metrics.gauge("bot_user_cache_misses", lambda: [({}, user_cache.misses)])
+    metrics.gauge("bot_subscription_heap_size", lambda: [({}, len(subscription_scheduler))])
+
+
+_metrics_server = None
+
+
+async def _serve_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass # هدرها نادیده گرفته می‌شوند
+        parts = request_line.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    global _metrics_server
+    if METRICS_PORT:
+        port = METRICS_PORT + SHARD_INDEX # هر worker روی پورت خودش
+        _metrics_server = await asyncio.start_server(_serve_metrics, METRICS_LISTEN, port)
+        print(f"Metrics on http://{METRICS_LISTEN}:{port}/metrics")
+
+
+async def stop_metrics_server():
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+
+
+async def on_startup(application: Application):
+    await asyncio.to_thread(open_database)
+    await initialize_conversation_persistence(application)
+    await start_metrics_server()
+    if SHARD_INDEX == 0: # در حالت چند پردازشی فقط worker اول کارهای سراسری را انجام می‌دهد
+        await resume_broadcasts(application)
+        await subscription_scheduler.start(application.job_queue)
+
+
+async def on_shutdown(application: Application):
+    await stop_metrics_server()
+    await close_database(application)
+
+
+def _top_histograms(name, limit, key=lambda item: item[1][0]):
+    return sorted(metrics.histograms(name).items(), key=key, reverse=True)[:limit]
+
+
+# /stats - خلاصه سنجه‌ها برای ادمین
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: # بررسی دسترسی ادمین
+        return
+    uptime = int(time.time() - metrics.started)
+    lines = [f"📊 آمار ربات (مدت اجرا: {uptime // 3600} ساعت و {uptime % 3600 // 60} دقیقه)", "", "⚙️ handlerها (تعداد، p50/p95 میلی‌ثانیه):"]
+    for labels, (count, total, p50, p95) in _top_histograms("bot_handler_seconds", 10):
+        name = dict(labels)["handler"] + (f" ({dict(labels)['action']})" if "action" in dict(labels) else "")
+        lines.append(f"• {name}: {count} | {p50 * 1000:g}/{p95 * 1000:g}")
+
+    lines += ["", "🗄 پرهزینه‌ترین دستورهای SQL (تعداد، میانگین و p95 میلی‌ثانیه):"]
+    for labels, (count, total, p50, p95) in _top_histograms("bot_db_query_seconds", 5, key=lambda item: item[1][1]):
+        lines.append(f"• {dict(labels)['statement'][:60]}: {count} | {total / count * 1000:.2f} | {p95 * 1000:g}")
+    commit = metrics.histograms("bot_db_commit_seconds").get(())
+    if commit:
+        lines.append(f"⏳ انتظار commit نوشتن‌ها p95: {commit[3] * 1000:g} ms | صف نوشتن: {db.queue_depth()}")
+
+    api_errors = defaultdict(int)
+    for labels, value in metrics.counters("bot_api_errors_total").items():
+        api_errors[dict(labels)["method"]] += value
+    lines += ["", "📡 Bot API (تعداد، p95 میلی‌ثانیه، خطا):"]
+    for labels, (count, total, p50, p95) in _top_histograms("bot_api_request_seconds", 8):
+        method = dict(labels)["method"]
+        lines.append(f"• {method}: {count} | {p95 * 1000:g} | {api_errors.get(method, 0)}")
 
+    lookups = user_cache.hits + user_cache.misses
+    if lookups:
+        lines += ["", f"🧠 نرخ برخورد کش کاربران: {user_cache.hits * 100 // lookups}٪ از {lookups}"]
+
+    conversations = conversation_state_counts(context.application)
+    if conversations:
+        lines += ["", "💬 مکالمه‌های فعال:"]
+        lines += [f"• {labels['conversation']} / {labels['state']}: {n}" for labels, n in conversations]
+    await update.message.reply_text("\n".join(lines))
+
+
+# **ذخیره وضعیت مکالمه‌ها و user_data در SQLite**
+# - فقط کلیدهای تغییرکرده نوشته می‌شوند: PTB کاربران/مکالمه‌های تغییرکرده را مشخص می‌کند و user_data فقط
+#   وقتی واقعا با آخرین نسخه ذخیره‌شده فرق داشته باشد نوشته می‌شود (نه بازنویسی کامل یک فایل pickle).
+# - هیچ چیزی در زمان راه‌اندازی خوانده نمی‌شود: user_data هر کاربر در اولین update او (refresh_user_data)
+#   و وضعیت مکالمه‌هایش توسط restore_persisted_state (قبل از بقیه handlerها) بارگذاری می‌شود.
+# - کاربرانی که بیش از PERSISTENCE_IDLE_SECONDS فعالیتی نداشته‌اند (مدت‌ها بعد از آخرین ذخیره) از حافظه کنار
+#   گذاشته می‌شوند و در update بعدی دوباره از دیتابیس بارگذاری می‌شوند؛ حافظه با کاربران فعال رشد می‌کند، نه با همه کاربران.
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "10")) # ثانیه
+PERSISTENCE_IDLE_SECONDS = float(os.getenv("PERSISTENCE_IDLE_SECONDS", "3600"))
+PERSISTENCE_EVICT_INTERVAL = 600 # ثانیه
+
+
+class SQLitePersistence(BasePersistence):
+    def __init__(self, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self._user_snapshots = {} # user_id -> JSON آخرین user_data ذخیره‌شده (فقط کاربران بارگذاری‌شده)
+        self._restored_keys = {} # user_id -> کلید مکالمه‌هایی که از دیتابیس بارگذاری شده‌اند
+        self._last_seen = OrderedDict() # user_id -> آخرین فعالیت (به ترتیب فعالیت، قدیمی‌ترین اول)
+        self._conversation_handlers = None # name -> ConversationHandler
+
+    def _touch(self, user_id):
+        self._last_seen[user_id] = time.monotonic()
+        self._last_seen.move_to_end(user_id)
+
+    def evict_idle(self, application, max_idle=PERSISTENCE_IDLE_SECONDS):
+        # وضعیت کاربران غیرفعال از حافظه حذف می‌شود؛ user_data در حافظه فقط اگر با نسخه ذخیره‌شده یکی باشد
+        cutoff = time.monotonic() - max_idle
+        evicted = 0
+        while self._last_seen:
+            user_id, seen = next(iter(self._last_seen.items()))
+            if seen > cutoff:
+                break
+            del self._last_seen[user_id]
+            snapshot = self._user_snapshots.pop(user_id, None)
+            self._restored_keys.pop(user_id, None)
+            data = application._user_data.get(user_id)
+            if (
+                data is not None and user_id not in application._user_ids_to_be_updated_in_persistence
+                and snapshot == json.dumps(data, sort_keys=True)
+            ):
+                del application._user_data[user_id]
+            evicted += 1
+        return evicted
+
+    # بارگذاری تنبل: در زمان راه‌اندازی چیزی خوانده نمی‌شود
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._touch(user_id)
+        if user_id in self._user_snapshots:
+            return
+        row = await db.fetchone("SELECT data FROM persisted_user_data WHERE user_id=?", (user_id,))
+        self._user_snapshots[user_id] = row[0] if row else json.dumps({})
+        if row:
+            for key, value in json.loads(row[0]).items():
+                user_data.setdefault(key, value) # مقدارهای موجود در حافظه مقدم هستند
+
+    async def restore_conversations(self, application, update):
+        chat, user = update.effective_chat, update.effective_user
+        if chat is None or user is None:
+            return
+        key = (chat.id, user.id) # کلید پیش‌فرض ConversationHandler (per_chat و per_user)
+        self._touch(user.id)
+        restored = self._restored_keys.setdefault(user.id, set())
+        if key in restored:
+            return
+        if self._conversation_handlers is None:
+            self._conversation_handlers = {
+                handler.name: handler for handler in iter_conversations(application) if handler.persistent
+            }
+        rows = await db.fetchall("SELECT name, state FROM persisted_conversations WHERE key=?", (json.dumps(key),))
+        restored.add(key)
+        for name, state in rows:
+            handler = self._conversation_handlers.get(name)
+            if handler is not None and key not in handler._conversations:
+                handler._conversations.update_no_track({key: json.loads(state)})
+
+    async def update_user_data(self, user_id, data):
+        self._touch(user_id)
+        snapshot = json.dumps(data, sort_keys=True)
+        if self._user_snapshots.get(user_id) == snapshot:
+            return # تغییری نکرده است
+        if data:
+            await db.execute(
+                "REPLACE INTO persisted_user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (user_id, snapshot, int(time.time()))
+            )
+        else:
+            await db.execute("DELETE FROM persisted_user_data WHERE user_id=?", (user_id,))
+        self._user_snapshots[user_id] = snapshot
+
+    async def drop_user_data(self, user_id):
+        await db.execute("DELETE FROM persisted_user_data WHERE user_id=?", (user_id,))
+        self._user_snapshots.pop(user_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None: # مکالمه تمام شده است
+            await db.execute("DELETE FROM persisted_conversations WHERE key=? AND name=?", (json.dumps(key), name))
+        else:
+            await db.execute(
+                "REPLACE INTO persisted_conversations (key, name, state, updated_at) VALUES (?, ?, ?, ?)",
+                (json.dumps(key), name, json.dumps(new_state), int(time.time()))
+            )
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        pass # هر تغییر همان لحظه در صف نوشتن دیتابیس قرار گرفته است
+
+
+async def evict_idle_persistence(context: ContextTypes.DEFAULT_TYPE):
+    context.application.persistence.evict_idle(context.application)
+
+
+# بعد از flood_guard و قبل از بقیه handlerها: وضعیت ذخیره‌شده مکالمه‌های کاربر را قبل از بررسی ConversationHandlerها بارگذاری می‌کند
+async def restore_persisted_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await context.application.persistence.restore_conversations(context.application, update)
+
+
+# **محافظ ارسال بیش از حد (flood guard)**
+# اولین handler هر update (گروه -2): برای هر کاربر و هر نوع عمل یک token bucket در حافظه نگه داشته می‌شود و
+# updateهای اضافه قبل از رسیدن به handlerها و دیتابیس با ApplicationHandlerStop دور ریخته می‌شوند.
+# کاربری که در یک پنجره زمانی بارها محدود شود، موقتا مسدود می‌شود (مدت مسدودیت با تکرار دو برابر می‌شود).
+# در حالت چند پردازشی هر کاربر همیشه به یک worker می‌رود، پس bucketهای محلی کافی هستند.
+def _parse_flood_limits(spec):
+    # "callback:8:1,command:5:0.5" -> {نوع: (ظرفیت، توکن در ثانیه)}
+    limits = {}
+    for item in filter(None, spec.split(",")):
+        action, burst, rate = item.split(":")
+        limits[action.strip()] = (float(burst), float(rate))
+    return limits
+
+
+FLOOD_LIMITS = _parse_flood_limits(os.getenv("FLOOD_LIMITS", "callback:8:1,command:5:0.5,message:10:1"))
+FLOOD_BAN_STRIKES = int(os.getenv("FLOOD_BAN_STRIKES", "20")) # تعداد محدود شدن در پنجره که به مسدودیت می‌رسد
+FLOOD_BAN_WINDOW = 60 # ثانیه
+FLOOD_BAN_SECONDS = int(os.getenv("FLOOD_BAN_SECONDS", "300"))
+FLOOD_BAN_MAX_SECONDS = 86400
+FLOOD_WARN_INTERVAL = 10 # حداقل فاصله هشدارهای «کمی صبر کنید» به یک کاربر (ثانیه)
+FLOOD_PRUNE_INTERVAL = 60 # ثانیه
+
+
+class FloodGuard:
+    def __init__(self, limits=FLOOD_LIMITS):
+        self.limits = limits
+        self._buckets = {} # (uid, action) -> [tokens, updated]
+        self._strikes = {} # uid -> [count, window_start]
+        self._bans = {} # uid -> (until, duration)
+        self._warned = {} # uid -> زمان آخرین هشدار
+
+    def check(self, uid, action):
+        # "ok"، "throttled"، "banned" (از قبل مسدود) یا "ban" (همین حالا مسدود شد)
+        now = time.monotonic()
+        ban = self._bans.get(uid)
+        if ban is not None and ban[0] > now:
+            return "banned"
+        burst, rate = self.limits[action]
+        bucket = self._buckets.get((uid, action))
+        if bucket is None:
+            bucket = self._buckets[(uid, action)] = [burst, now]
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return "ok"
+        strikes = self._strikes.get(uid)
+        if strikes is None or now - strikes[1] > FLOOD_BAN_WINDOW:
+            strikes = self._strikes[uid] = [0, now]
+        strikes[0] += 1
+        if strikes[0] < FLOOD_BAN_STRIKES:
+            return "throttled"
+        del self._strikes[uid]
+        duration = FLOOD_BAN_SECONDS if ban is None else min(ban[1] * 2, FLOOD_BAN_MAX_SECONDS)
+        self._bans[uid] = (now + duration, duration)
+        return "ban"
+
+    def ban_remaining(self, uid):
+        ban = self._bans.get(uid)
+        return max(0, ban[0] - time.monotonic()) if ban else 0
+
+    def should_warn(self, uid):
+        now = time.monotonic()
+        if now - self._warned.get(uid, -FLOOD_WARN_INTERVAL) < FLOOD_WARN_INTERVAL:
+            return False
+        self._warned[uid] = now
+        return True
+
+    def prune(self):
+        # حذف bucketهای پر و بی‌استفاده و سابقه‌های قدیمی تا حافظه با تعداد کاربران فعال (نه کل کاربران) رشد کند
+        now = time.monotonic()
+        for key, (tokens, updated) in list(self._buckets.items()):
+            burst, rate = self.limits[key[1]]
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+        for uid, (count, started) in list(self._strikes.items()):
+            if now - started > FLOOD_BAN_WINDOW:
+                del self._strikes[uid]
+        for uid, (until, duration) in list(self._bans.items()):
+            if now - until > FLOOD_BAN_MAX_SECONDS: # بعد از یک روز رفتار عادی، مدت مسدودیت بعدی از اول حساب می‌شود
+                del self._bans[uid]
+        for uid, warned in list(self._warned.items()):
+            if now - warned > FLOOD_WARN_INTERVAL:
+                del self._warned[uid]
+
+
+flood_guard_state = FloodGuard()
+
+
+def flood_action(update):
+    if update.callback_query:
+        return "callback"
+    if update.message:
+        return "command" if update.message.text and update.message.text.startswith("/") else "message"
+    return None
+
+
+async def flood_guard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    action = flood_action(update)
+    if user is None or user.id == ADMIN_ID or action not in flood_guard_state.limits:
+        return
+    verdict = flood_guard_state.check(user.id, action)
+    if verdict == "ok":
+        return
+    metrics.inc("bot_throttled_total", action=action, verdict=verdict)
+    if verdict == "ban":
+        metrics.inc("bot_flood_bans_total")
+    warn = verdict == "throttled" and flood_guard_state.should_warn(user.id)
+    try:
+        if update.callback_query:
+            # هر callback پاسخ می‌گیرد (بعد از اولین هشدار بی‌صدا)، وگرنه دکمه تا timeout در حال بارگذاری می‌ماند
+            await update.callback_query.answer("⏳ لطفاً کمی صبر کنید..." if warn else None)
+        elif warn:
+            await update.effective_message.reply_text("⏳ لطفاً کمی آهسته‌تر پیام بدهید.")
+        if verdict == "ban":
+            minutes = max(1, round(flood_guard_state.ban_remaining(user.id) / 60))
+            await context.bot.send_message(chat_id=user.id, text=f"⛔ به دلیل ارسال بیش از حد، دسترسی شما برای {minutes} دقیقه محدود شد.")
+    except TelegramError:
+        pass
+    raise ApplicationHandlerStop
+
+
+async def prune_flood_guard(context: ContextTypes.DEFAULT_TYPE):
+    flood_guard_state.prune()
+
+
+# حالت اجرا: polling (پیش‌فرض) یا webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# آدرس عمومی webhook پشت reverse proxy، مثال: https://bot.example.com/telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# سرور HTTP محلی که reverse proxy درخواست‌ها را به آن می‌فرستد
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# اگر تنظیم نشود در هر اجرا یک مقدار تصادفی ساخته و با setWebhook ثبت می‌شود
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# برای HTTPS مستقیم روی listener محلی (بدون reverse proxy)
+WEBHOOK_CERT = os.getenv("WEBHOOK_CERT")
+WEBHOOK_KEY = os.getenv("WEBHOOK_KEY")
+
+# نوع updateهایی که هر نوع handler مصرف می‌کند
+_HANDLER_UPDATE_TYPES = (
+    (CallbackQueryHandler, Update.CALLBACK_QUERY),
+    (CommandHandler, Update.MESSAGE),
+    (MessageHandler, Update.MESSAGE),
+)
+
+
+def allowed_updates_for(handlers):
+    # فقط updateهایی که handler ثبت‌شده‌ای برایشان داریم از تلگرام گرفته می‌شوند (handlers: group -> فهرست handlerها)
+    update_types = set()
+
+    def collect(handler):
+        if isinstance(handler, ConversationHandler):
+            for h in handler.entry_points + handler.fallbacks:
+                collect(h)
+            for state_handlers in handler.states.values():
+                for h in state_handlers:
+                    collect(h)
+            return
+        if isinstance(handler, ConversationRouter):
+            for conversation in handler.conversations:
+                collect(conversation)
+            return
+        for handler_type, update_type in _HANDLER_UPDATE_TYPES:
+            if isinstance(handler, handler_type):
+                update_types.add(update_type)
+
+    for group_handlers in handlers.values():
+        for handler in group_handlers:
+            collect(handler)
+    return sorted(update_types)
+
+
+# ساخت Application و ثبت تمام handlerها
+# updateهای کاربران مختلف همزمان پردازش می‌شوند (انتظار یک handler برای دیتابیس یا Bot API بقیه را متوقف نمی‌کند)،
+# ولی updateهای یک کاربر پشت یک قفل به ترتیب رسیدن اجرا می‌شوند تا ترتیب پیام‌ها و وضعیت مکالمه‌ها حفظ شود.
+# process_update در PTB قبل از do_process_update سمافور خودش را می‌گیرد؛ آن سمافور اینجا عملاً نامحدود است و
+# سقف همزمانی بعد از قفل کاربر گرفته می‌شود تا updateهای در صف یک کاربر شلوغ جای کاربران دیگر را اشغال نکنند.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates=BOT_CONCURRENT_UPDATES):
+        super().__init__(2 ** 31 - 1)
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates) # فقط update سر صف هر کاربر برای آن رقابت می‌کند
+        self._locks = {} # کلید کاربر -> [قفل، تعداد updateهای در انتظار/در حال اجرا]
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: # قفل کاربرانی که update در جریان ندارند نگه داشته نمی‌شود
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def application_builder():
+    builder = (
+        Application.builder().token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .request(InstrumentedRequest(connection_pool_size=BOT_CONCURRENT_UPDATES * 2))
+        .get_updates_request(InstrumentedRequest())
+    )
+    if BOT_API_URL:
+        builder.base_url(BOT_API_URL)
+    return builder
+
+
+# همه handlerها بدون ساختن Application (برای محاسبه allowed_updates در ingress هم استفاده می‌شود)
+def build_handlers(callback_router):
     # ConversationHandlers (تمام entry_points به CallbackQueryHandler تغییر کرده‌اند)
     buy_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(buy, pattern="^buy_account$")],
+        entry_points=[CallbackQueryHandler(buy, pattern=callback_action("buy_account"))],
         states={
-            1: [CallbackQueryHandler(confirm_purchase, pattern="^buy_type_")],
+            1: [CallbackQueryHandler(idempotent(confirm_purchase, durable=True), pattern=callback_action("buy_type"))],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="buy",
+        persistent=True,
     )
 
     app_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(get_app, pattern="^get_app$")],
+        entry_points=[CallbackQueryHandler(get_app, pattern=callback_action("get_app"))],
         states={
-            2: [CallbackQueryHandler(send_app_link, pattern="^app_type_")],
+            2: [CallbackQueryHandler(send_app_link, pattern=callback_action("app_type"))],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="app",
+        persistent=True,
     )
 
     service_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(get_service, pattern="^get_services$")],
+        entry_points=[CallbackQueryHandler(get_service, pattern=callback_action("get_services"))],
         states={
-            3: [CallbackQueryHandler(send_service, pattern="^service_type_")],
+            3: [CallbackQueryHandler(idempotent(send_service, durable=True), pattern=callback_action("service_type"))],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="service",
+        persistent=True,
     )
 
     discount_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_discount, pattern="^activate_discount$")],
+        entry_points=[CallbackQueryHandler(ask_discount, pattern=callback_action("activate_discount"))],
         states={
             4: [MessageHandler(filters.TEXT & ~filters.COMMAND, apply_discount)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="discount",
+        persistent=True,
     )
 
     transfer_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_target, pattern="^transfer_credit$")],
+        entry_points=[CallbackQueryHandler(ask_target, pattern=callback_action("transfer_credit"))],
         states={
             5: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_amount)],
             6: [MessageHandler(filters.TEXT & ~filters.COMMAND, do_transfer)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="transfer",
+        persistent=True,
     )
 
     topup_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_topup, pattern="^top_up_credit$")],
+        entry_points=[CallbackQueryHandler(ask_topup, pattern=callback_action("top_up_credit"))],
         states={
             7: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_topup_request)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="topup",
+        persistent=True,
     )
 
     # Admin's Add Service Handler (entry point changed to CallbackQuery)
     admin_add_service_conv_handler = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(ask_service, pattern="^admin_add_service_v2ray$|^admin_add_service_openvpn$|^admin_add_service_proxy$")
+            CallbackQueryHandler(ask_service, pattern=callback_action("admin_add_service"))
         ],
         states={
-            8: [MessageHandler((filters.TEXT | filters.Document) & ~filters.COMMAND, save_service)],
+            8: [MessageHandler((filters.TEXT | filters.Document.ALL) & ~filters.COMMAND, save_service)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="admin_add_service",
+        persistent=True,
     )
 
     # Admin's Add Discount Handler (entry point changed to CallbackQuery)
     admin_add_discount_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_discount_admin, pattern="^admin_add_discount$")],
+        entry_points=[CallbackQueryHandler(ask_discount_admin, pattern=callback_action("admin_add_discount"))],
         states={
             9: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_discount_code)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="admin_add_discount",
+        persistent=True,
+    )
+
+    admin_bulk_codes_conv_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(ask_bulk_codes, pattern=callback_action("admin_bulk_codes"))],
+        states={
+            BULK_CODES: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, save_bulk_codes)],
+        },
+        fallbacks=[CommandHandler("start", start)],
+        name="admin_bulk_codes",
+        persistent=True,
+    )
+
+    admin_stock_conv_handler = ConversationHandler(
+        entry_points=[CallbackQueryHandler(ask_stock_product, pattern=callback_action("admin_stock"))],
+        states={
+            STOCK_PRODUCT: [CallbackQueryHandler(ask_stock_items, pattern=callback_action("stock_product"))],
+            STOCK_ITEMS: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, save_stock_items)],
+        },
+        fallbacks=[CommandHandler("start", start)],
+        name="admin_stock",
+        persistent=True,
+    )
+
+    admin_import_users_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("import_users", ask_users_csv)],
+        states={
+            BULK_USERS: [MessageHandler(filters.Document.ALL, import_users_csv)],
+        },
+        fallbacks=[CommandHandler("start", start)],
+        name="admin_import_users",
+        persistent=True,
     )
 
     # Admin's Charge User Handler (entry point changed to CallbackQuery)
     admin_charge_user_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_charge, pattern="^admin_charge_user$")],
+        entry_points=[CallbackQueryHandler(ask_charge, pattern=callback_action("admin_charge_user"))],
         states={
             10: [MessageHandler(filters.TEXT & ~filters.COMMAND, do_charge)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="admin_charge_user",
+        persistent=True,
     )
 
     # Admin's Broadcast Handler (entry point changed to CallbackQuery)
     admin_broadcast_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(ask_broadcast, pattern="^admin_broadcast$")],
+        entry_points=[CallbackQueryHandler(ask_broadcast, pattern=callback_action("admin_broadcast"))],
         states={
             11: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_broadcast)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="admin_broadcast",
+        persistent=True,
     )
 
     support_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(message_to_support, pattern="^message_support$")],
+        entry_points=[CallbackQueryHandler(message_to_support, pattern=callback_action("message_support"))],
         states={
-            12: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_support_message)],
+            12: [MessageHandler(~filters.COMMAND, send_support_message)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="support",
+        persistent=True,
     )
 
     # Generalize send_account_conv_handler to send_item_conv_handler
     send_item_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(start_send_item, pattern=r"^send_item_to_")],
+        entry_points=[CallbackQueryHandler(idempotent(start_send_item, durable=True, until_done=True), pattern=callback_action("send_item"))],
         states={
-            SENDING_ITEM_DETAILS: [MessageHandler(filters.TEXT & ~filters.COMMAND, send_item_to_user)],
+            SENDING_ITEM_DETAILS: [MessageHandler(~filters.COMMAND, send_item_to_user)],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="send_item",
+        persistent=True,
+        allow_reentry=True, # زدن دکمه ارسال دیگری کار نیمه‌تمام قبلی را رها می‌کند (و دکمه آن دوباره آزاد می‌شود)
     )
 
     # New Admin Chat Conversation Handler
     admin_chat_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(start_admin_chat, pattern="^admin_chat_with_user$")],
+        entry_points=[CallbackQueryHandler(start_admin_chat, pattern=callback_action("admin_chat_with_user"))],
         states={
             ADMIN_CHAT_TARGET_USER: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_chat_user_id)],
             ADMIN_CHATTING: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r"^\/exit_chat$"), admin_send_message_to_user),
+                MessageHandler(~filters.COMMAND, admin_send_message_to_user),
                 CommandHandler("exit_chat", exit_admin_chat)
             ],
         },
         fallbacks=[CommandHandler("start", start)],
+        name="admin_chat",
+        persistent=True,
     )
 
 
-    # --- افزودن Handlers به Application ---
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("admin", admin))
-    application.add_handler(CommandHandler("about", about)) # /about command
-    application.add_handler(CommandHandler("score", my_credit)) # /score command
-    application.add_handler(CommandHandler("myinfo", my_status)) # /myinfo command
+    # --- فهرست Handlerها به تفکیک group ---
+    handlers = defaultdict(list)
+    # بارگذاری وضعیت ذخیره‌شده کاربر قبل از همه handlerها
+    handlers[-2].append(TypeHandler(Update, flood_guard))
+    handlers[-1].append(TypeHandler(Update, restore_persisted_state))
+    handlers[0].append(CommandHandler("start", start))
+    handlers[0].append(CommandHandler("admin", admin))
+    handlers[0].append(CommandHandler("about", about)) # /about command
+    handlers[0].append(CommandHandler("score", my_credit)) # /score command
+    handlers[0].append(CommandHandler("myinfo", my_status)) # /myinfo command
+    handlers[0].append(CommandHandler("history", credit_history)) # /history command
+    handlers[0].append(CommandHandler("stats", stats)) # /stats command (admin)
+    handlers[0].append(CommandHandler("export_users", export_users)) # /export_users command (admin)
+    handlers[0].append(CommandHandler("export_ledger", export_ledger)) # /export_ledger command (admin)
+    handlers[0].append(CommandHandler("orders", orders)) # /orders command (admin)
 
     # Add the new exit chat command handler (even though it's inside conv, useful if typed outside)
-    application.add_handler(CommandHandler("exit_chat", exit_admin_chat))
+    handlers[0].append(CommandHandler("exit_chat", exit_admin_chat))
 
-    # General CallbackQueryHandlers for single actions (e.g. status/credit)
-    application.add_handler(CallbackQueryHandler(my_credit_inline_handler, pattern="^my_credit_inline$"))
-    application.add_handler(CallbackQueryHandler(my_status_inline_handler, pattern="^my_status_inline$"))
-    application.add_handler(CallbackQueryHandler(about, pattern="^show_about$")) # Callback for "درباره ما"
+    # Single-step callbacks go through one router handler (dict lookup on the parsed action)
+    callback_router.route("my_credit_inline", my_credit_inline_handler)
+    callback_router.route("my_status_inline", my_status_inline_handler)
+    callback_router.route("show_about", about) # Callback for "درباره ما"
 
-    # Admin panel button handlers (all now CallbackQueryHandlers)
-    application.add_handler(CallbackQueryHandler(list_pending, pattern="^admin_list_pending$"))
-    application.add_handler(CallbackQueryHandler(approve_user, pattern="^approve_")) # This handler remains
+    # Admin panel button handlers
+    callback_router.route("admin_list_pending", list_pending)
+    callback_router.route("approve", idempotent(approve_user, durable=True))
+    callback_router.route("pending", pending_page)
+    callback_router.route("pending_approve", idempotent(pending_approve)) # همان پیام صفحه بعدا دوباره استفاده می‌شود؛ فقط کش حافظه
+    callback_router.route("pending_approve_page", idempotent(pending_approve_page))
+    callback_router.route("orders", orders_inline)
+    callback_router.route("orders_page", orders_page)
+    callback_router.route("order_close", order_close)
+    callback_router.route("orders_stock", idempotent(orders_stock))
+    handlers[0].append(callback_router.handler())
 
 
     # افزودن تمام ConversationHandlers
-    application.add_handler(buy_conv_handler)
-    application.add_handler(app_conv_handler)
-    application.add_handler(service_conv_handler)
-    application.add_handler(discount_conv_handler)
-    application.add_handler(transfer_conv_handler)
-    application.add_handler(topup_conv_handler)
-    application.add_handler(admin_add_service_conv_handler)
-    application.add_handler(admin_add_discount_conv_handler)
-    application.add_handler(admin_charge_user_conv_handler)
-    application.add_handler(admin_broadcast_conv_handler)
-    application.add_handler(support_conv_handler)
-    application.add_handler(send_item_conv_handler) # Generalised item sending handler
-    application.add_handler(admin_chat_conv_handler) # New chat handler
-
-
-    # اجرای ربات (polling)
-    print("Bot started...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    handlers[0].append(ConversationRouter([
+        buy_conv_handler,
+        app_conv_handler,
+        service_conv_handler,
+        discount_conv_handler,
+        transfer_conv_handler,
+        topup_conv_handler,
+        admin_add_service_conv_handler,
+        admin_add_discount_conv_handler,
+        admin_bulk_codes_conv_handler,
+        admin_stock_conv_handler,
+        admin_import_users_conv_handler,
+        admin_charge_user_conv_handler,
+        admin_broadcast_conv_handler,
+        support_conv_handler,
+        send_item_conv_handler, # Generalised item sending handler
+        admin_chat_conv_handler, # New chat handler
+    ]))
+    # reply روی پیام‌های relayشده (بعد از مکالمه‌ها تا پیام‌های داخل یک مکالمه را نگیرد)
+    handlers[0].append(MessageHandler(filters.REPLY & ~filters.COMMAND, relay_reply))
+    return dict(handlers)
+
+
+def build_application(updater=True):
+    builder = application_builder().persistence(SQLitePersistence())
+    if not updater: # worker: updateها از پردازش ingress می‌رسند
+        builder.updater(None)
+    application = builder.post_init(on_startup).post_stop(flush_admin_notifications).post_shutdown(on_shutdown).build()
+
+    # مسیریاب callbackها مال همین Application است تا ساخت دوباره Application مسیرها را دو بار wrap نکند
+    callback_router = application.bot_data["callback_router"] = CallbackRouter()
+    for group, group_handlers in build_handlers(callback_router).items():
+        application.add_handlers(group_handlers, group=group)
+
+    application.job_queue.run_repeating(prune_flood_guard, interval=FLOOD_PRUNE_INTERVAL, first=FLOOD_PRUNE_INTERVAL)
+    application.job_queue.run_repeating(evict_idle_persistence, interval=PERSISTENCE_EVICT_INTERVAL, first=PERSISTENCE_EVICT_INTERVAL)
+    # checkpoint دوره‌ای موجودی‌ها
+    if SHARD_INDEX == 0:
+        application.job_queue.run_repeating(checkpoint_balances, interval=LEDGER_CHECKPOINT_INTERVAL, first=LEDGER_CHECKPOINT_INTERVAL)
+        application.job_queue.run_repeating(prune_relay, interval=86400, first=3600)
+        application.job_queue.run_repeating(prune_callback_claims, interval=86400, first=3600)
+
+    instrument_handlers(application)
+    register_gauges(application)
+    return application
+
+
+# **حالت چند پردازشی (sharding بر اساس user_id)**
+# با BOT_WORKERS > 1 یک پردازش ingress (polling یا webhook) updateها را می‌گیرد و هر update را بر اساس شناسه کاربر
+# به یکی از N پردازش worker می‌فرستد که handlerهای معمول را اجرا می‌کنند:
+# - همه updateهای یک کاربر به یک worker می‌روند و آنجا به ترتیب پردازش می‌شوند (ترتیب و وضعیت مکالمه محلی می‌ماند)
+# - هر worker اتصال‌های SQLite خودش را دارد؛ WAL و BEGIN IMMEDIATE با busy_timeout نوشتن‌های پردازش‌ها را سریالی می‌کنند
+# - تغییر کش‌ها (کاربران، سرویس‌ها، کدهای تخفیف) از طریق صف ورودی workerهای دیگر به آن‌ها اعلام می‌شود
+# - کارهای سراسری (ادامه ارسال همگانی، checkpoint موجودی‌ها) فقط در worker اول اجرا می‌شوند
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+WORKER_SUPERVISE_INTERVAL = 5 # ثانیه
+
+SHARD_INDEX = 0 # شماره worker همین پردازش
+_peer_inboxes = [] # صف ورودی workerهای دیگر (فقط در حالت چند پردازشی)
+
+
+def publish_invalidation(kind, key=None):
+    for inbox in _peer_inboxes:
+        inbox.put(("invalidate", kind, key))
+
+
+def apply_invalidation(kind, key):
+    if kind == "user":
+        user_cache.forget(key)
+    elif kind == "all_users":
+        user_cache.clear(publish=False)
+    elif kind == "services":
+        service_cache.clear()
+    elif kind == "discount_codes":
+        discount_codes.reload()
+    elif kind == "subscription":
+        subscription_scheduler.push(*key, publish=False)
+
+
+def shard_for(update, workers):
+    # کاربر (یا در نبود کاربر، چت) تعیین می‌کند update به کدام worker برود
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = 0
+    return key % workers
+
+
+def _pump_inbox(inbox, loop, application, stopped):
+    # روی یک thread جدا: پیام‌های صف ورودی به ترتیب به event loop همین worker تحویل داده می‌شوند
+    def deliver(message):
+        if message[0] == "update":
+            application.update_queue.put_nowait(Update.de_json(message[1], application.bot))
+        else:
+            apply_invalidation(message[1], message[2])
+
+    while True:
+        message = inbox.get()
+        if message is None:
+            loop.call_soon_threadsafe(stopped.set)
+            return
+        loop.call_soon_threadsafe(deliver, message)
+
+
+async def serve_worker(index, inboxes):
+    application = build_application(updater=False)
+    stopped = asyncio.Event()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    threading.Thread(
+        target=_pump_inbox, args=(inboxes[index], asyncio.get_running_loop(), application, stopped),
+        name="worker-inbox", daemon=True
+    ).start()
+    print(f"Worker {index} started (pid {os.getpid()})")
+    await stopped.wait()
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+
+def run_worker(index, inboxes):
+    # نقطه شروع هر پردازش worker
+    global SHARD_INDEX, _peer_inboxes
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # توقف از طریق ingress (پیام None در صف) انجام می‌شود
+    SHARD_INDEX = index
+    _peer_inboxes = [inbox for i, inbox in enumerate(inboxes) if i != index]
+    asyncio.run(serve_worker(index, inboxes))
+
+
+def run_ingress(workers):
+    context = multiprocessing.get_context("spawn")
+    inboxes = [context.Queue() for _ in range(workers)]
+    processes = []
+
+    def start_worker(index):
+        process = context.Process(target=run_worker, args=(index, inboxes), name=f"bot-worker-{index}", daemon=True)
+        process.start()
+        return process
+
+    processes.extend(start_worker(i) for i in range(workers))
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        inboxes[shard_for(update, workers)].put(("update", update.to_dict()))
+
+    async def supervise(context: ContextTypes.DEFAULT_TYPE):
+        # worker از کار افتاده با همان صف ورودی دوباره راه‌اندازی می‌شود (updateهای در صف از دست نمی‌روند)
+        for index, process in enumerate(processes):
+            if not process.is_alive():
+                print(f"Worker {index} exited with code {process.exitcode}; restarting")
+                processes[index] = start_worker(index)
+
+    ingress = application_builder().build()
+    ingress.add_handler(TypeHandler(Update, forward))
+    ingress.job_queue.run_repeating(supervise, interval=WORKER_SUPERVISE_INTERVAL, first=WORKER_SUPERVISE_INTERVAL)
+    try:
+        run_application(ingress, allowed_updates_for(build_handlers(CallbackRouter())), f"ingress for {workers} workers")
+    finally:
+        for inbox in inboxes:
+            inbox.put(None)
+        for process in processes:
+            process.join(timeout=30)
+
+
+def run_application(application, allowed_updates, description="single process"):
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        # اجرای ربات (webhook)
+        print(f"Bot started (webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}, {description})...")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            cert=WEBHOOK_CERT,
+            key=WEBHOOK_KEY,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        # اجرای ربات (polling)
+        print(f"Bot started ({description})...")
+        application.run_polling(allowed_updates=allowed_updates)
+
+
+# تابع اصلی
+def main():
+    if BOT_WORKERS > 1:
+        run_ingress(BOT_WORKERS)
+        return
+    application = build_application()
+    run_application(application, allowed_updates_for(application.handlers))
 
 if __name__ == '__main__':
     main()